@@ -1,11 +1,61 @@
 import os
 import os.path
+import shlex
+import shutil
 from glob import glob
 from time import time
 
 import batou.lib.archive
 from batou.component import Attribute
 
+# Leading bytes of compressed data and the `tar` option to decompress it.
+TAR_COMPRESSION = (
+    (b"\x1f\x8b", "--gzip"),
+    (b"\xfd7zXZ\x00", "--xz"),
+    (b"\x28\xb5\x2f\xfd", "--zstd"),
+    (b"BZh", "--bzip2"),
+)
+
+# Multi-threaded decompressors for the `tar` options above, in order of
+# preference. `{threads}` is replaced by the number of threads.
+PARALLEL_DECOMPRESSORS = {
+    "--gzip": ("pigz -p {threads}",),
+    "--xz": ("xz -T{threads}",),
+    "--zstd": ("zstd -T{threads}",),
+    "--bzip2": ("lbzip2 -n {threads}", "pbzip2 -p{threads}"),
+}
+
+
+def tar_compression_args(head, threads=None):
+    """Return the `tar` arguments to decompress an archive which starts
+    with the bytes `head`.
+
+    If `threads` is given (0 means one per CPU), an installed multi-threaded
+    decompressor is used if there is one.
+    """
+    for magic, option in TAR_COMPRESSION:
+        if head.startswith(magic):
+            break
+    else:
+        return []
+    if threads is not None:
+        threads = threads or os.cpu_count() or 1
+        for program in PARALLEL_DECOMPRESSORS[option]:
+            if shutil.which(program.split()[0]):
+                return [
+                    f"--use-compress-program={program.format(threads=threads)}"
+                ]
+    return [option]
+
+
+def finish_marker(target):
+    """Return the path of the marker `SingleUntar` writes once it extracted
+    an archive to `target`.
+    """
+    return os.path.join(
+        os.path.dirname(target), f".{os.path.basename(target)}.finished-extract"
+    )
+
 
 class SingleUntar(batou.lib.archive.Untar):
     """Extract archive *once*
@@ -15,20 +65,24 @@ class SingleUntar(batou.lib.archive.Untar):
     any changes, so we skip the file-by-file validation which speeds things
     up considerably.
 
+    The compression is detected from the archive's content. Besides the
+    formats of `Untar`, `.tar.zst` archives are supported. Multi-threaded
+    decompressors (`pigz`, `xz -T`, `zstd -T`, `lbzip2` or `pbzip2`) are
+    used if installed, with `threads` threads (default: one per CPU).
     """
 
     _required_params_ = {"target": "."}
 
+    suffixes = batou.lib.archive.Untar.suffixes + (".tar.zst", ".tzst")
+
     cleanup_markers_after_days = Attribute(int, default=None)
+    threads = Attribute(int, default=0)
 
     def configure(self):
         super().configure()
         self._markers_to_unlink = []
         self._only_marker_cleanup = False
-        self._finish_marker = os.path.join(
-            os.path.dirname(self.target),
-            f".{os.path.basename(self.target)}.finished-extract",
-        )
+        self._finish_marker = finish_marker(self.target)
 
     def verify(self):
         # If a deployment does this for a while, a lot of these markers accumulate.
@@ -57,9 +111,24 @@ class SingleUntar(batou.lib.archive.Untar):
 
     def update(self):
         if not self._only_marker_cleanup:
-            super().update()
+            self._extract()
             self.touch(self.target)
             self.touch(self._finish_marker)
 
         for old_marker in self._markers_to_unlink:
             os.remove(old_marker)
+
+    def _extract(self):
+        with open(self.archive, "rb") as f:
+            head = f.read(8)
+        args = [
+            "tar",
+            "-x",
+            "-f",
+            self.archive,
+            "-C",
+            self.target,
+            f"--strip-components={self.strip}",
+        ]
+        args += tar_compression_args(head, self.threads)
+        self.cmd(" ".join(shlex.quote(arg) for arg in args))
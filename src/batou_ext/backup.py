@@ -0,0 +1,180 @@
+"""Regular database backups streamed to S3."""
+
+import json
+import shlex
+from importlib.resources import files
+from unittest.mock import Mock
+
+import batou.component
+import batou.lib.file
+
+import batou_ext.cron
+import batou_ext.mysql
+import batou_ext.postgres
+import batou_ext.python
+import batou_ext.s3
+
+
+class S3Backup(batou.component.Component):
+    """Back up a database to S3 regularly with a systemd timer.
+
+    Usage::
+
+        self += batou_ext.postgres.DB("mydb", owner="myuser")
+        self += batou_ext.backup.S3Backup(
+            "mydb",
+            database=self._,
+            s3=self.s3,
+            bucketname="backups",
+            retention_days=30)
+
+    `database` is a `batou_ext.postgres.DB` (dumped with `pg_dump`) or a
+    `batou_ext.mysql.MySQLGeneric` (dumped with `mysqldump`). Other sources
+    can be backed up by passing a shell command which writes the dump to
+    stdout as `dump_command` instead.
+
+    The dump is piped through `compressor` (multi-threaded `zstd` by
+    default, e.g. use `pigz` with the suffix `.gz` instead) and uploaded
+    to `<prefix><timestamp><suffix>` as a multipart upload while it is
+    created, so it is never written to local disk. Up to `concurrency`
+    parts of `chunk_size` bytes are uploaded at once, which bounds the
+    memory used. If the dump fails, the upload is aborted.
+
+    With `retention_days`, a lifecycle rule expiring the backups is added
+    to the bucket. The size, duration and throughput of each backup are
+    printed to the journal of the job. Set `metrics_file` to also write
+    them as Prometheus metrics, e.g. for the node exporter's textfile
+    collector.
+
+    The upload needs a Python with `boto3`. Unless `python` is given, a
+    virtualenv is created for it.
+    """
+
+    _required_params_ = {
+        "bucketname": "bucket",
+        "dump_command": "true",
+        "s3": Mock(
+            endpoint_url="https://s3.example.com",
+            access_key_id="id",
+            secret_access_key="secret",
+        ),
+    }
+    namevar = "tag"
+    s3 = None
+    database = None
+    dump_command = batou.component.Attribute(str, default=None)
+    bucketname = batou.component.Attribute(str)
+    prefix = batou.component.Attribute(str, default=None)
+    onCalendar = batou.component.Attribute(str, default="02:00:00")
+    timeout = batou.component.Attribute(str, default="6h")
+    compressor = batou.component.Attribute(str, default="zstd -T0 -q")
+    suffix = batou.component.Attribute(str, default=".zst")
+    chunk_size = batou.component.Attribute(int, default=32 * 1024 * 1024)
+    concurrency = batou.component.Attribute(int, default=4)
+    retention_days = batou.component.Attribute(int, default=None)
+    metrics_file = None
+    python = None
+    python_version = batou.component.Attribute(str, default="3.12")
+
+    def configure(self):
+        if self.prefix is None:
+            self.prefix = f"{self.tag}/"
+        if self.dump_command is None:
+            self.dump_command = self._dump_command()
+
+        self += batou.lib.file.File(
+            f"{self.tag}-s3.json",
+            mode=0o600,
+            sensitive_data=True,
+            is_template=False,
+            content=json.dumps(
+                {
+                    "endpoint_url": self.s3.endpoint_url,
+                    "access_key_id": self.s3.access_key_id,
+                    "secret_access_key": self.s3.secret_access_key,
+                }
+            ),
+        )
+        self.config_file = self._.path
+
+        self += batou.lib.file.File(
+            "s3-backup.py",
+            content=(
+                files(__spec__.parent) / "resources/s3-backup.py"
+            ).read_bytes(),
+            is_template=False,
+            mode=0o755,
+        )
+        self.script = self._.path
+
+        if self.python is None:
+            self += batou.lib.file.File(
+                "s3-backup-requirements.txt", content="boto3\n"
+            )
+            self += batou_ext.python.VirtualEnvRequirements(
+                version=self.python_version, requirements_path=self._.path
+            )
+            self.python = self._.python
+
+        args = [
+            self.python,
+            self.script,
+            f"--config={self.config_file}",
+            f"--bucket={self.bucketname}",
+            f"--prefix={self.prefix}",
+            f"--suffix={self.suffix}",
+            f"--name={self.tag}",
+            f"--chunk-size={self.chunk_size}",
+            f"--concurrency={self.concurrency}",
+        ]
+        if self.metrics_file:
+            args.append(f"--metrics-file={self.map(self.metrics_file)}")
+        args.append(f"{self.dump_command} | {self.compressor}")
+        self.command = " ".join(shlex.quote(arg) for arg in args)
+
+        self += batou_ext.cron.SystemdTimer(
+            f"s3-backup-{self.tag}",
+            command=self.command,
+            onCalendar=self.onCalendar,
+            timeout=self.timeout,
+            description=f"Back up {self.tag} to S3",
+        )
+
+        if self.retention_days:
+            self += batou_ext.s3.LifecycleRule(
+                f"batou-backup-{self.tag}",
+                s3=self.s3,
+                bucketname=self.bucketname,
+                prefix=self.prefix,
+                expiration_days=self.retention_days,
+            )
+
+    def _dump_command(self):
+        db = self.database
+        if isinstance(db, batou_ext.postgres.DB):
+            # Compression is done by `compressor`, multi-threaded.
+            return (
+                f"{db.command_prefix} pg_dump --format=custom --compress=0"
+                f" {shlex.quote(db.db)}"
+            )
+        if isinstance(db, batou_ext.mysql.MySQLGeneric):
+            self += batou.lib.file.File(
+                f"{self.tag}-my.cnf",
+                mode=0o600,
+                sensitive_data=True,
+                is_template=False,
+                content=(
+                    "[client]\n"
+                    f"user={db.username}\n"
+                    f"password={db.password}\n"
+                    f"port={db.port}\n"
+                ),
+            )
+            return (
+                f"mysqldump --defaults-extra-file={self._.path}"
+                " --single-transaction --quick --routines"
+                f" {shlex.quote(db.database)}"
+            )
+        raise ValueError(
+            f"Cannot back up {db!r}, pass a `dump_command` instead."
+        )
@@ -1,4 +1,7 @@
+import errno
+import fcntl
 import glob
+import hashlib
 import os
 import os.path
 import shutil
@@ -15,6 +18,9 @@ import batou.lib.git
 
 import batou_ext.ssh
 
+# Suffixes of files which belong to a target of `SymlinkAndCleanup`.
+SIDECAR_SUFFIXES = (".checksum", ".part", ".part.json")
+
 
 class SymlinkAndCleanup(batou.component.Component):
     """
@@ -31,6 +37,20 @@ class SymlinkAndCleanup(batou.component.Component):
     # clean up a all downloaded versions but the last two
     self += SymlinkAndCleanup(new_file.path, pattern = "*.tar.gz")
     ```
+
+    Files next to the linked targets with the `etag_suffix` or one of the
+    `SIDECAR_SUFFIXES` (written by e.g. `batou_ext.s3.Download`) are kept
+    along with them.
+
+    If the files matching `pattern` are git worktrees, set
+    `prune_worktrees_of` to their repository so that `git worktree prune`
+    removes the administrative data of discarded worktrees there.
+
+    If the files were linked from an `ArtifactCache` (see e.g. the
+    `artifact_cache` of `batou_ext.s3.Download`), pass the cache as
+    `artifact_cache`: files linked to an artifact are removed directly
+    instead of being moved to the trash, which would keep them linked, and
+    the cache is evicted afterwards.
     """
 
     namevar = "current"
@@ -45,6 +65,8 @@ class SymlinkAndCleanup(batou.component.Component):
     systemd_write_max_iops = 100
     trashdir = None
     trash_config_file_name = batou.component.Attribute(str, default="trash.nix")
+    prune_worktrees_of = None
+    artifact_cache = None
 
     ## DEPRECATED, do not use
     use_systemd_run_async_cleanup = False
@@ -96,29 +118,25 @@ class SymlinkAndCleanup(batou.component.Component):
             pass
 
     def _list_removals(self):
-        candidates = glob.glob(self.pattern)
-        candidates.extend(glob.glob(self.pattern + self.etag_suffix))
+        # Files kept next to the targets, e.g. by `batou_ext.s3.Download`.
+        suffixes = ["", self.etag_suffix, *SIDECAR_SUFFIXES]
+        candidates = set()
+        for suffix in suffixes:
+            candidates.update(glob.glob(self.pattern + suffix))
 
         current = self._link(self._current_link)
         last = self._link(self._last_link)
         if current == self.current:
             # keep last+current
-            self.remove(candidates, current)
-            self.remove(candidates, last)
-            if current is not None:
-                self.remove(candidates, current + self.etag_suffix)
-            if last is not None:
-                self.remove(candidates, last + self.etag_suffix)
+            keep = [current, last]
         else:
             # keep current + new current"
-            self.remove(candidates, current)
-            self.remove(candidates, self.current)
-            if current is not None:
-                self.remove(candidates, current + self.etag_suffix)
-            if self.current is not None:
-                self.remove(candidates, self.current + self.etag_suffix)
+            keep = [current, self.current]
+        for name in keep:
+            if name is not None:
+                candidates.difference_update(name + s for s in suffixes)
 
-        return candidates
+        return sorted(candidates)
 
     def verify(self):
         with self.chdir(self.dir):
@@ -160,8 +178,135 @@ class SymlinkAndCleanup(batou.component.Component):
 
             for c in candidates:
                 batou.output.annotate(f"Removing: {candidates}")
+                if self.artifact_cache and self.artifact_cache.release(c):
+                    continue
                 self.trash.discard(c)
 
+        if candidates and self.prune_worktrees_of:
+            with self.chdir(self.prune_worktrees_of):
+                self.cmd("git worktree prune")
+
+        if candidates and self.artifact_cache:
+            self.artifact_cache.evict()
+
+
+class ArtifactCache:
+    """A host-wide cache of downloaded artifacts, addressed by their
+    content (a checksum or an S3 ETag).
+
+    Artifacts are stored once in `directory` and hardlinked into their
+    targets, or copied (as a reflink where supported) if they are on
+    another file system. The targets must therefore never be modified in
+    place.
+
+    If the artifacts exceed `max_size` bytes, the least recently used ones
+    are evicted. An artifact is only evicted while it is not linked to any
+    target, i.e. while targets retained by `SymlinkAndCleanup` exist it is
+    kept. Links in a `DeploymentTrash` count, too, so targets must be
+    removed with `release` (which `SymlinkAndCleanup` does if it is given
+    the cache).
+    """
+
+    def __init__(self, directory, max_size=None):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+
+    def path(self, key):
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def _link(self, source, target):
+        tmp = f"{target}.{os.getpid()}.tmp"
+        try:
+            os.link(source, tmp)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                raise
+            subprocess.run(
+                ["cp", "--reflink=auto", source, tmp],
+                check=True,
+                capture_output=True,
+            )
+        os.replace(tmp, target)
+
+    def get(self, key, target):
+        """Link the artifact `key` to `target`.
+
+        Returns whether the artifact was in the cache.
+        """
+        path = self.path(key)
+        try:
+            self._link(path, target)
+        except FileNotFoundError:
+            return False
+        Path(path + ".used").touch()
+        return True
+
+    def put(self, key, source):
+        """Store the file `source` as the artifact `key`."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        self._link(source, path)
+        Path(path + ".used").touch()
+        self.evict()
+
+    def release(self, target):
+        """Remove `target` if it is a link to an artifact.
+
+        Returns whether it was removed.
+        """
+        try:
+            stat = os.lstat(target)
+        except FileNotFoundError:
+            return False
+        if not Path(target).is_file() or stat.st_nlink < 2:
+            return False
+        if not os.path.isdir(self.directory):
+            return False
+        for entry in os.scandir(self.directory):
+            if "." in entry.name or entry.inode() != stat.st_ino:
+                continue
+            if entry.stat().st_dev == stat.st_dev:
+                os.unlink(target)
+                return True
+        return False
+
+    def evict(self):
+        """Remove the least recently used artifacts which are not linked
+        anywhere until the cache fits into `max_size`.
+        """
+        if not self.max_size or not os.path.isdir(self.directory):
+            return
+        with open(os.path.join(self.directory, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            size = 0
+            for entry in os.scandir(self.directory):
+                if "." in entry.name:
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                try:
+                    used = os.stat(entry.path + ".used").st_mtime
+                except FileNotFoundError:
+                    used = 0
+                size += stat.st_size
+                entries.append((used, entry.path, stat))
+            for used, path, stat in sorted(entries):
+                if size <= self.max_size:
+                    break
+                if stat.st_nlink > 1:
+                    continue
+                batou.output.annotate(
+                    f"Evicting {os.path.basename(path)} from artifact cache."
+                )
+                os.unlink(path)
+                if os.path.exists(path + ".used"):
+                    os.unlink(path + ".used")
+                size -= stat.st_size
+
 
 class DeploymentTrash(batou.component.Component):
     """A trash folder that is regularly cleaned up by systemd's tmpfiles.
@@ -228,3 +373,73 @@ class DeploymentTrash(batou.component.Component):
                 "check that the deployment trash dir and the directory you want to trash are on the same device"
             )
             raise e
+
+
+class HardlinkSyncDirectory(batou.component.Component):
+    """Sync `source` into the directory `path` like `Directory(source=...)`,
+    but hardlink files which are unchanged compared to `link_dest`.
+
+    This has the semantics of `rsync --link-dest`: a file which has the same
+    size, mtime and permissions in `link_dest` is not copied but hardlinked
+    from there. It is useful to create versioned copies of a directory (e.g.
+    one per release) without writing and storing unchanged files again.
+
+    ```python
+    self += HardlinkSyncDirectory(
+        "releases/2.0",
+        source="checkout",
+        link_dest="releases/current",
+        exclude=(".git",),
+    )
+    ```
+
+    `link_dest` is resolved when the component is deployed, so it can be a
+    symlink like the `current` link of `SymlinkAndCleanup`. If it does not
+    exist (yet), all files are copied.
+
+    Attention: the hardlinked files are shared between the directories. Never
+    modify synced files in place afterwards (e.g. with a `File` component) as
+    this changes them in `link_dest` as well. Instead, add those files to
+    `exclude` so they are created as separate files.
+    """
+
+    _required_params_ = {"source": "."}
+    namevar = "path"
+    source = None
+    link_dest = None
+    exclude = ()
+
+    def configure(self):
+        self.path = self.map(self.path)
+        self.source = self.map(self.source)
+        if self.link_dest:
+            self.link_dest = self.map(self.link_dest)
+
+    @property
+    def exclude_arg(self):
+        return " ".join(f"--exclude '{x}'" for x in self.exclude)
+
+    def verify(self):
+        if not os.path.isdir(self.path):
+            raise batou.UpdateNeeded()
+        stdout, stderr = self.cmd(
+            f"rsync -rlptn --itemize-changes {self.exclude_arg}"
+            f" {self.source}/ {self.path}"
+        )
+        # Lines starting with `.` only report attribute changes, e.g. the
+        # mtime of directories.
+        if any(not line.startswith(".") for line in stdout.splitlines()):
+            raise batou.UpdateNeeded()
+
+    def update(self):
+        link_dest_arg = ""
+        if self.link_dest and os.path.isdir(self.link_dest):
+            link_dest = os.path.realpath(self.link_dest)
+            if link_dest != os.path.realpath(self.path):
+                link_dest_arg = f"--link-dest={link_dest}"
+        # No `--inplace`: changed files must replace the hardlinks instead
+        # of writing through them.
+        self.cmd(
+            f"rsync -rlpt {link_dest_arg} {self.exclude_arg}"
+            f" {self.source}/ {self.path}"
+        )
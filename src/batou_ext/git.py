@@ -1,3 +1,5 @@
+import fcntl
+import hashlib
 import os
 import os.path
 import urllib.parse
@@ -5,9 +7,10 @@ import urllib.parse
 import batou.component
 import batou.lib.file
 import batou.lib.git
+import batou.utils
 
 import batou_ext.ssh
-from batou_ext.file import SymlinkAndCleanup
+from batou_ext.file import HardlinkSyncDirectory, SymlinkAndCleanup
 
 
 class GitCheckout(batou.component.Component):
@@ -40,6 +43,24 @@ class GitCheckout(batou.component.Component):
 
     The option sync_parent_folder is allowing you to sync into a different
     folder than the current one.
+
+    With `hardlink=True`, a new prepared directory is built by hardlinking
+    all files that did not change compared to the previous prepared directory
+    and only copying the changed ones (see `HardlinkSyncDirectory`). The
+    previous directory is taken from the `current` symlink next to the
+    prepared directories as created by `symlink_and_cleanup()`; set
+    `hardlink_from` if you link it differently. Files you customize in the
+    prepared directory must be listed in `exclude` in this mode, as changing
+    a hardlinked file in place changes it in the previous directory, too.
+
+    With `worktree=True`, the prepared directory is created as a `git
+    worktree` of the clone instead (see `GitWorktree`) and `exclude` is
+    applied as sparse-checkout patterns. Only a checkout of the revision is
+    written then, no directory sync. Old worktrees are pruned by
+    `symlink_and_cleanup()`.
+
+    The options `reference_cache`, `partial_clone` and `shallow` reduce fetch
+    traffic and disk usage of the clone, see `batou_ext.git.Clone`.
     """
 
     _required_params_ = {
@@ -54,6 +75,12 @@ class GitCheckout(batou.component.Component):
     git_port = None
     exclude = ()
     sync_parent_folder = None
+    hardlink = False
+    hardlink_from = None
+    worktree = False
+    reference_cache = None
+    partial_clone = False
+    shallow = False
 
     # Automatically scan the remote ssh hostkey (once)
     scan_host = True
@@ -75,16 +102,31 @@ class GitCheckout(batou.component.Component):
             # Add remote host to known hosts
             self += batou_ext.ssh.ScanHost(self.git_host, port=self.git_port)
 
+        if self.worktree and self.hardlink:
+            raise ValueError(
+                "GitCheckout: `worktree` and `hardlink` are mutually exclusive."
+            )
+
         # Check whether we need a SSH key
         if urllib.parse.urlparse(self.git_clone_url).scheme == "ssh":
             self.require("sshkeypair")
 
         # Get a recent checkout
-        self += batou.lib.git.Clone(
-            self.git_clone_url,
-            revision=self.git_revision,
-            target=self.git_target,
-        )
+        if self.reference_cache or self.partial_clone or self.shallow:
+            self += Clone(
+                self.git_clone_url,
+                revision=self.git_revision,
+                target=self.git_target,
+                reference_cache=self.reference_cache,
+                partial=self.partial_clone,
+                shallow=self.shallow,
+            )
+        else:
+            self += batou.lib.git.Clone(
+                self.git_clone_url,
+                revision=self.git_revision,
+                target=self.git_target,
+            )
 
         # Actually sync into a working copy where parent-component can
         # add custom files
@@ -98,19 +140,286 @@ class GitCheckout(batou.component.Component):
             self.prepared_path = self.map(
                 "prepared-{}".format(self.git_revision)
             )
+        if self.worktree:
+            self += GitWorktree(
+                self.prepared_path,
+                repository=self.git_target,
+                revision=self.git_revision,
+                exclude=self.exclude,
+            )
+            return
         self += batou.lib.file.Directory(self.prepared_path, leading=True)
-        self += batou.lib.file.Directory(
+        if self.hardlink:
+            self += HardlinkSyncDirectory(
+                self.prepared_path,
+                source=self.git_target,
+                link_dest=self.hardlink_from
+                or os.path.join(os.path.dirname(self.prepared_path), "current"),
+                exclude=((".git",) + tuple(self.exclude)),
+            )
+        else:
+            self += batou.lib.file.Directory(
+                self.prepared_path,
+                source=self.git_target,
+                exclude=((".git",) + self.exclude),
+            )
+
+    def symlink_and_cleanup(self):
+        return SymlinkAndCleanup(
             self.prepared_path,
-            source=self.git_target,
-            exclude=((".git",) + self.exclude),
+            pattern="prepared-*",
+            prune_worktrees_of=(
+                self.map(self.git_target) if self.worktree else None
+            ),
         )
 
-    def symlink_and_cleanup(self):
-        return SymlinkAndCleanup(self.prepared_path, pattern="prepared-*")
+
+class GitWorktree(batou.component.Component):
+    """Check out `revision` of the git clone `repository` as a detached
+    worktree at `path`.
+
+    Usage::
+
+        self += batou_ext.git.GitWorktree(
+            "prepared-1234567892134131313132231",
+            repository="checkout",
+            revision="1234567892134131313132231",
+            exclude=("src/my.conf", "db/dump.sql"))
+
+    The worktree shares the object store with `repository`, so only the
+    files of `revision` are written. The paths in `exclude` are left out of
+    the checkout via sparse-checkout patterns (gitignore syntax, which
+    behaves like rsync's for plain paths), so you can add customized files
+    there.
+
+    Remove a worktree by moving its directory away (e.g. with
+    `SymlinkAndCleanup`/`DeploymentTrash`) and running `git worktree prune`
+    in `repository`.
+    """
+
+    _required_params_ = {"repository": ".", "revision": "commit-hash"}
+    namevar = "path"
+    repository = None
+    revision = None
+    exclude = ()
+
+    def configure(self):
+        self.path = self.map(self.path)
+        self.repository = self.map(self.repository)
+
+    @property
+    def _sparse_patterns(self):
+        return ["/*"] + [f"!{pattern}" for pattern in self.exclude]
+
+    def _git(self, args):
+        stdout, _ = self.cmd(f"git {args}", ignore_returncode=True)
+        return stdout.strip()
+
+    def _head(self):
+        if not os.path.isfile(os.path.join(self.path, ".git")):
+            return None
+        with self.chdir(self.path):
+            # Empty if the worktree was lost, e.g. by a fresh clone.
+            return self._git("rev-parse --verify -q HEAD") or None
+
+    def verify(self):
+        if self._head() != self.revision:
+            raise batou.UpdateNeeded()
+        if self.exclude:
+            with self.chdir(self.path):
+                patterns = self._git("sparse-checkout list").splitlines()
+            if patterns != self._sparse_patterns:
+                raise batou.UpdateNeeded()
+
+    def update(self):
+        if not self._head():
+            batou.lib.file.ensure_path_nonexistent(self.path)
+            with self.chdir(self.repository):
+                self.cmd("git worktree prune")
+                self.cmd(
+                    f"git worktree add --detach --no-checkout {self.path} "
+                    f"{self.revision}"
+                )
+        with self.chdir(self.path):
+            if self.exclude:
+                patterns = " ".join(f"'{p}'" for p in self._sparse_patterns)
+                self.cmd(f"git sparse-checkout set --no-cone {patterns}")
+            else:
+                self.cmd("git sparse-checkout disable")
+            self.cmd(f"git checkout --force --detach {self.revision}")
+
+
+class Clone(batou.lib.git.Clone):
+    """A `batou.lib.git.Clone` which fetches and stores less data.
+
+    Usage::
+
+        self += batou_ext.git.Clone(
+            "https://git.example.org/example-repo.git",
+            revision="1234567892134131313132231",
+            target="checkout",
+            reference_cache="~/.cache/batou-git",
+            partial=True)
+
+    * `reference_cache`: a directory with one bare repository per clone URL
+      which is shared by all clones of that URL on the host. The clone borrows
+      the objects from there via git alternates, so objects are fetched and
+      stored only once per host. As the clones depend on its objects, the
+      cache is never garbage collected. Don't run `git gc` in there.
+    * `partial`: partial clone (`--filter=blob:none`), i.e. file contents are
+      only fetched for the revision that gets checked out. The
+      `reference_cache` is always fetched in full as it is shared with full
+      clones.
+    * `shallow`: only fetch the wanted revision instead of its whole history.
+
+    Only the wanted branch, tag or revision is fetched into the clone, so
+    the server must allow fetching revisions by their id (GitHub and GitLab
+    do) if `revision` is used.
+    """
+
+    _required_params_ = {"revision": "commit-hash"}
+    reference_cache = None
+    partial = False
+    shallow = False
+
+    def configure(self):
+        super().configure()
+        self.reference = None
+        if self.reference_cache:
+            self.reference_cache = self.map(self.reference_cache)
+            self += batou.lib.file.Directory(self.reference_cache, leading=True)
+            url_digest = hashlib.sha256(self.url.encode("utf-8")).hexdigest()
+            self.reference = os.path.join(
+                self.reference_cache, f"{url_digest[:16]}.git"
+            )
+
+    @property
+    def _filter_arg(self):
+        return "--filter=blob:none" if self.partial else ""
+
+    @property
+    def _refspec(self):
+        if self.branch:
+            return (
+                f"+refs/heads/{self.branch}:refs/remotes/origin/{self.branch}"
+            )
+        if self.tag:
+            return f"+refs/tags/{self.tag}:refs/tags/{self.tag}"
+        return self.revision
+
+    def has_incoming_changesets(self):
+        # `git fetch --dry-run` would fetch all branches, without the filter
+        # and depth, and report every other branch as new.
+        if self.branch:
+            ref = f"refs/heads/{self.branch}"
+            local_ref = f"refs/remotes/origin/{self.branch}"
+        else:
+            ref = local_ref = f"refs/tags/{self.tag}"
+        with self.chdir(self.target):
+            stdout, _ = self.cmd(f"git ls-remote origin {ref}")
+            remote = {
+                name: id_
+                for id_, name in (line.split() for line in stdout.splitlines())
+            }.get(ref)
+            stdout, _ = self.cmd(
+                f"git rev-parse -q --verify {local_ref}", ignore_returncode=True
+            )
+        return remote != stdout.strip()
+
+    def update(self):
+        if self.reference:
+            self._update_reference()
+        if self._force_clone:
+            batou.lib.git.ensure_empty_directory(self.target)
+            with self.chdir(self.target):
+                self.cmd("git init -q")
+                self.cmd(f"git remote add origin {self.url}")
+                if self.reference:
+                    # This is what `git clone --reference` does.
+                    with open(".git/objects/info/alternates", "w") as f:
+                        f.write(os.path.join(self.reference, "objects") + "\n")
+
+        with self.chdir(self.target):
+            for filepath in self.untracked_files():
+                os.unlink(os.path.join(self.target, filepath))
+            depth = "--depth 1" if self.shallow else ""
+            self.cmd(
+                f"git fetch {self._filter_arg} {depth} origin {self._refspec}"
+            )
+            if self.branch:
+                self.cmd(
+                    f"git checkout --force -B {self.branch} "
+                    f"origin/{self.branch}"
+                )
+            elif self.tag:
+                self.cmd(f"git reset --hard refs/tags/{self.tag}")
+            else:
+                self.cmd(f"git reset --hard {self.revision}")
+            self.cmd("git submodule update --init --recursive")
+
+    def _update_reference(self):
+        # Lock against other deployments updating the same cache.
+        with open(f"{self.reference}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(self.reference):
+                self.cmd(f"git init -q --bare {self.reference}")
+                with self.chdir(self.reference):
+                    # Clones using this as alternate would break if objects
+                    # they need got pruned.
+                    self.cmd("git config gc.auto 0")
+                    self.cmd(f"git remote add origin {self.url}")
+            with self.chdir(self.reference):
+                # Never filtered: full clones borrow their blobs from here,
+                # too.
+                self.cmd(
+                    "git fetch -q origin"
+                    " '+refs/heads/*:refs/heads/*' '+refs/tags/*:refs/tags/*'"
+                )
+
+
+def status(component, pathspec="", accelerated=False, fsmonitor=False):
+    """Return `git status --porcelain` for the repository in the current
+    directory.
+
+    With `accelerated`, the repository is configured to use the untracked
+    cache and index preloading (and the builtin fsmonitor daemon with
+    `fsmonitor`, if the git version supports it on the platform). The full
+    status is then only run if a cheap check of the index against HEAD and
+    of the untracked files finds anything. Changes inside of submodules are
+    not seen by the cheap check.
+    """
+    if accelerated:
+        settings = {"core.untrackedCache": "true", "core.preloadIndex": "true"}
+        if fsmonitor:
+            settings["core.fsmonitor"] = "true"
+        for key, value in settings.items():
+            stdout, _ = component.cmd(
+                f"git config --get {key}", ignore_returncode=True
+            )
+            if stdout.strip() != value:
+                component.cmd(f"git config {key} {value}")
+        try:
+            component.cmd(f"git diff-index --quiet HEAD -- {pathspec}")
+        except batou.utils.CmdExecutionError:
+            # Changes, stale index stat data or no HEAD: let status decide.
+            pass
+        else:
+            stdout, _ = component.cmd(
+                "git ls-files --others --exclude-standard --directory "
+                f"--no-empty-directory -- {pathspec}"
+            )
+            if not stdout.strip():
+                return ""
+    stdout, _ = component.cmd(f"git status --porcelain {pathspec}")
+    return stdout
 
 
 class Commit(batou.component.Component):
-    """Commit a file."""
+    """Commit a file.
+
+    Set `accelerated` to speed up checking for changes in big checkouts,
+    see `batou_ext.git.status`.
+    """
 
     _required_params_ = {"message": "text"}
     namevar = "filename"
@@ -118,6 +427,8 @@ class Commit(batou.component.Component):
     workingdir = "."
     author_name = "Batou"
     author_email = "batou@flyingcircus.io"
+    accelerated = False
+    fsmonitor = False
 
     def configure(self):
         assert self.message
@@ -137,8 +448,11 @@ class Commit(batou.component.Component):
 
     def has_changes(self):
         with self.chdir(self.workingdir):
-            stdout, stderr = self.cmd(
-                "git status --porcelain {{component.filename}}"
+            stdout = status(
+                self,
+                self.filename,
+                accelerated=self.accelerated,
+                fsmonitor=self.fsmonitor,
             )
         return bool(stdout.strip())
 
@@ -243,10 +557,15 @@ class StopDeployOnLocalGitChange(batou.component.Component):
             self.git_url,
             revision="01234567abcd",
             target=target)
+
+    Set `accelerated` to speed up the check for big checkouts, see
+    `batou_ext.git.status`.
     """
 
     namevar = "target"
     target = None
+    accelerated = False
+    fsmonitor = False
 
     def verify(self):
         if not os.path.exists(self.target):
@@ -254,7 +573,9 @@ class StopDeployOnLocalGitChange(batou.component.Component):
         if not os.path.exists(os.path.join(self.target, ".git")):
             return
         with self.chdir(self.target):
-            stdout, stderr = self.cmd("git status --porcelain")
+            stdout = status(
+                self, accelerated=self.accelerated, fsmonitor=self.fsmonitor
+            )
         changes = bool(stdout.strip())
         if changes:
-            raise RuntimeError(f"Deployment aborted:\n{stdout}\n{stderr}")
+            raise RuntimeError(f"Deployment aborted:\n{stdout}")
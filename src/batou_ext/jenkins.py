@@ -1,26 +1,141 @@
 """Helper for Jenkins pipeline deployments."""
 
 import argparse
+import concurrent.futures
 import configparser
+import hashlib
 import json
+import os
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 
-def git_ls_remote(url, ref):
-    cmd = subprocess.Popen(
-        ["git", "ls-remote", url, ref], stdout=subprocess.PIPE
-    )
+def git_ls_remote_refs(url):
+    """Return all refs advertised by `url` as a dict of ref: revision.
+
+    The dict is in the order of `git ls-remote` and also contains the peeled
+    revisions of annotated tags as `refs/tags/<tag>^{}`.
+    """
+    cmd = subprocess.Popen(["git", "ls-remote", url], stdout=subprocess.PIPE)
     stdout, _ = cmd.communicate()
     if cmd.returncode != 0:
         raise ValueError(
-            f"'git ls-remote {url} {ref}' failed with exit code {cmd.returncode}. Stderr is printed above."
+            f"'git ls-remote {url}' failed with exit code {cmd.returncode}. Stderr is printed above."
         )
-    if stdout:
-        return stdout.decode("ascii").split("\t", 1)
+    refs = {}
+    for line in stdout.decode("ascii").splitlines():
+        rev, ref = line.split("\t", 1)
+        refs.setdefault(ref, rev)
+    return refs
+
+
+def cache_dir(name):
+    """Return the directory of the cache `name` of the batou_ext tools."""
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "batou_ext",
+        name,
+    )
+
+
+class RefCache:
+    """Cache of `git_ls_remote_refs` results on disk, one file per URL.
+
+    Calling the cache with a URL returns its refs, from the cache if they
+    are younger than `ttl` seconds and from the remote otherwise.
+    """
+
+    def __init__(self, ttl=60, directory=None):
+        self.ttl = ttl
+        self.directory = directory or cache_dir("ls-remote")
+
+    def _path(self, url):
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def cached(self, url):
+        """Return the cached refs of `url` and their age in seconds, or
+        `(None, None)` if there are none.
+        """
+        try:
+            with open(self._path(url)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None, None
+        if data.get("url") != url:
+            return None, None
+        return data["refs"], time.time() - data["time"]
+
+    def refresh(self, url):
+        """Get the refs of `url` from the remote and cache them."""
+        refs = git_ls_remote_refs(url)
+        data = {"url": url, "time": time.time(), "refs": refs}
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self._path(url))
+        except OSError:
+            # The cache is an optimization only.
+            pass
+        return refs
+
+    def refresh_in_background(self, url, callback):
+        """Refresh the refs of `url` in a thread and pass them to `callback`.
+
+        Returns the (daemon) thread.
+        """
+
+        def run():
+            try:
+                refs = self.refresh(url)
+            except ValueError:
+                return
+            callback(refs)
 
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
 
-def git_resolve(url, version):
+    def __call__(self, url):
+        refs, age = self.cached(url)
+        if refs is not None and age < self.ttl:
+            return refs
+        return self.refresh(url)
+
+
+def match_ref(refs, version):
+    """Resolve `version` in the result of `git_ls_remote_refs`.
+
+    Matches like `git ls-remote <url> <version>`, i.e. the first ref which
+    is `version` or ends with `/<version>` wins.
+    """
+    for ref, rev in refs.items():
+        if ref.endswith("^{}"):
+            continue
+        if ref != version and not ref.endswith(f"/{version}"):
+            continue
+        if ref.startswith("refs/tags/"):
+            # An annotated tag (e.g. due to its own message or a signature)
+            # has its own revision which is not equal to the revision of the
+            # commit that got tagged. The difference is crucial in some cases
+            # however, e.g. if the commit's rev is part of the S3 URL
+            # containing the frontend artifacts for this deploy.
+            rev = refs.get(f"{ref}^{{}}", rev)
+        return rev
+
+
+def git_resolve(url, version, ls_remote=git_ls_remote_refs):
+    """Resolve `version` (a revision, branch or tag) of the repository at
+    `url` to a revision.
+
+    `ls_remote` is called with `url` to get the refs if needed, see
+    `git_ls_remote_refs`.
+    """
     if len(version) == 40:
         # revision.
         try:
@@ -30,24 +145,7 @@ def git_resolve(url, version):
         else:
             return version
 
-    ls_remote = git_ls_remote(url, version)
-    if ls_remote:
-        rev, full_refspec = ls_remote
-        # If full_refspec indicates that a tag was found, retry with `^{}`
-        # to check if the tag is annotated: an annotated tag (e.g. due to its
-        # own message or a signature) has its own revision which is not equal
-        # to the revision of the commit that got tagged.
-        # The difference is crucial in some cases however, e.g. if the commit's
-        # rev is part of the S3 URL containing the frontend artifacts for this
-        # deploy.
-        if full_refspec.startswith("refs/tags/"):
-            ls_remote_tag = git_ls_remote(url, f"{version}^{{}}")
-            # If the result is empty here, the tag is not annotated, thus using the
-            # rev from the first invocation is correct. We don't end up here because of
-            # an error anymore since non-zero returns now fail with a ValueError earlier.
-            if ls_remote_tag:
-                rev = ls_remote_tag[0]
-        return rev
+    return match_ref(ls_remote(url), version)
 
 
 class VersionsUpdater:
@@ -56,18 +154,34 @@ class VersionsUpdater:
         "pass": "update_pass_value",
     }
 
-    def __init__(self, versions_file, version_mapping_json):
+    # Number of services that are resolved concurrently.
+    max_workers = 8
+
+    def __init__(self, versions_file, version_mapping_json, ref_cache_ttl=0):
+        # Refs are only taken from the cache if asked to explicitly: a stale
+        # branch head would deploy an outdated revision.
+        self.ls_remote = (
+            RefCache(ref_cache_ttl) if ref_cache_ttl else git_ls_remote_refs
+        )
         self.version_mapping = json.loads(version_mapping_json)
         self.versions_file = versions_file
         self.config = configparser.ConfigParser()
         self.config.read(self.versions_file)
+        self._resolved = {}
+        self._refs = {}
+        self._refs_locks = {}
 
     def __call__(self):
-        for service, version in sorted(self.version_mapping.items()):
-            if not version:
-                # leave empty to keep current version
-                continue
-            self.update(service, version)
+        # leave empty to keep current version
+        versions = {
+            service: version
+            for service, version in sorted(self.version_mapping.items())
+            if version
+        }
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            self.resolve_all(pool, versions)
+            for service, version in versions.items():
+                self.update(service, version)
 
         with open(self.versions_file, "w") as f:
             self.config.write(f)
@@ -83,8 +197,31 @@ class VersionsUpdater:
         func = getattr(self, self.UPDATERS[mode])
         func(service, version, args)
 
+    def resolve_all(self, pool, versions):
+        """Start resolving the versions of all services in git mode in
+        `pool`. The refs of each URL are only fetched once.
+        """
+        for service, version in versions.items():
+            mode = self.config[service].get("update", "git-resolve")
+            if mode.split(":", 1)[0] != "git-resolve":
+                continue
+            url = self.config.get(service, "url")
+            self._refs_locks.setdefault(url, threading.Lock())
+            self._resolved[service] = pool.submit(
+                git_resolve, url, version, self._ls_remote
+            )
+
+    def _ls_remote(self, url):
+        with self._refs_locks[url]:
+            if url not in self._refs:
+                self._refs[url] = self.ls_remote(url)
+            return self._refs[url]
+
     def update_git(self, service, version, extra_args):
-        resolved = git_resolve(self.config.get(service, "url"), version)
+        if service in self._resolved:
+            resolved = self._resolved.pop(service).result()
+        else:
+            resolved = git_resolve(self.config.get(service, "url"), version)
         if not resolved:
             raise ValueError(
                 "%s: Could not resolve version %s." % (service, version)
@@ -118,8 +255,8 @@ def list_components(versions_file, verbose=False):
     print(json.dumps(result, sort_keys=True))
 
 
-def set_versions(versions_file, version_mapping_json):
-    vu = VersionsUpdater(versions_file, version_mapping_json)
+def set_versions(versions_file, version_mapping_json, ref_cache_ttl=0):
+    vu = VersionsUpdater(versions_file, version_mapping_json, ref_cache_ttl)
     vu()
 
 
@@ -148,6 +285,12 @@ def main():
     p.add_argument(
         "version_mapping_json", help="JSON: mapping of service: version"
     )
+    p.add_argument(
+        "--ref-cache-ttl",
+        type=int,
+        default=0,
+        help="Use refs cached on disk if younger than this many seconds",
+    )
     p.set_defaults(func=set_versions)
 
     args = parser.parse_args()
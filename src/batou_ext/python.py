@@ -1,14 +1,43 @@
+import fcntl
+import hashlib
 import json
 import os.path
 import shlex
 from glob import glob
+from importlib.resources import files
 from textwrap import dedent
 
+import batou
+import batou.lib.file
 import batou.lib.python
 from batou.component import Attribute, Component, ConfigString
 from batou.lib.file import File
 from batou.utils import CmdExecutionError
 
+from batou_ext.file import DeploymentTrash
+
+# Marks a fully built venv in `VirtualEnvRequirements.store_dir`.
+STORE_COMPLETE_MARKER = ".batou-store-complete"
+# Directory in `store_dir` with one symlink per component's `store_link`.
+STORE_REFS = ".refs"
+# Last lock file installed by `Pipenv` in incremental mode.
+PIPENV_STATE_FILE = ".batou-pipfile-lock.json"
+
+
+class InstallStep(Component):
+    """Run `verify_install`/`update_install` of the parent as a step.
+
+    Sub-components added after this one (e.g. `PrecompileBytecode`) are only
+    deployed once the parent's packages are installed and are verified and
+    updated on their own.
+    """
+
+    def verify(self):
+        self.parent.verify_install()
+
+    def update(self):
+        self.parent.update_install()
+
 
 class Pipenv(Component):
     """Sync pipenv
@@ -27,31 +56,184 @@ class Pipenv(Component):
     * For NixOS you can `nix-env -iA nixos.pipenv`. You will also need
       `nixos.which` and the python version the Pipfile specifies.
 
+    Incremental mode (`incremental=True`):
+
+    By default, `.venv` is deleted and rebuilt from scratch on every change
+    of `Pipfile`/`Pipfile.lock`. In incremental mode, the lock file that was
+    installed last is remembered in `.venv`. On changes, only packages whose
+    lock entry changed are installed (with `--require-hashes`) and packages
+    that were dropped from the lock are uninstalled. If a changed entry is not
+    pinned to a version (e.g. VCS or path dependencies), `pipenv sync` is run
+    on the existing venv instead.
+
+    The venv is only rebuilt if the required Python version in the lock file
+    changes or the venv is not functional anymore.
+
     """
 
     target = None
 
+    incremental = False
+
+    # Compile `.pyc` files of the target (including `.venv`) and
+    # `precompile_paths` after syncing, see `PrecompileBytecode`.
+    precompile = False
+    precompile_paths = ()
+
     def configure(self):
         if self.target is None:
             self.target = self.workdir
         self.venv = os.path.join(self.workdir, self.target, ".venv")
         self.executable = os.path.join(self.venv, "bin/python")
 
-    def verify(self):
-        with self.chdir(self.target):
-            self.assert_file_is_current(
-                self.executable, ["Pipfile", "Pipfile.lock"]
+        self += InstallStep()
+        if self.precompile:
+            self += PrecompileBytecode(
+                os.path.join(self.workdir, self.target),
+                python=self.executable,
+                extra_paths=list(self.precompile_paths),
             )
+
+    def verify_install(self):
+        with self.chdir(self.target):
+            if self.incremental:
+                state = self._load_state()
+                if state is None or not os.path.exists("Pipfile.lock"):
+                    raise batou.UpdateNeeded()
+                # `_meta.hash` only covers the Pipfile, not what `pipenv lock`
+                # resolved.
+                lock = self._load_lock()
+                if state["requires"] != lock["_meta"].get("requires", {}):
+                    raise batou.UpdateNeeded()
+                if state["default"] != lock["default"]:
+                    raise batou.UpdateNeeded()
+            else:
+                self.assert_file_is_current(
+                    self.executable, ["Pipfile", "Pipfile.lock"]
+                )
             # Is this Python (still) functional 'enough'
             # from a setuptools/distribute perspective?
             self.assert_cmd(
                 '{{component.executable}} -c "from importlib.resources import files"'
             )
 
-    def update(self):
+    def update_install(self):
         with self.chdir(self.target):
-            self.cmd("rm -rf .venv")
-            self.cmd("pipenv sync", env={"PIPENV_VENV_IN_PROJECT": "1"})
+            if self.incremental:
+                self._update_incremental()
+            else:
+                self._rebuild()
+
+    def _rebuild(self):
+        self.cmd("rm -rf .venv")
+        self._sync()
+
+    def _sync(self):
+        self.cmd("pipenv sync", env={"PIPENV_VENV_IN_PROJECT": "1"})
+
+    @property
+    def _state_file(self):
+        return os.path.join(self.venv, PIPENV_STATE_FILE)
+
+    def _load_lock(self):
+        with open("Pipfile.lock") as f:
+            return json.load(f)
+
+    def _load_state(self):
+        try:
+            with open(self._state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_state(self, lock):
+        state = dict(
+            requires=lock["_meta"].get("requires", {}),
+            default=lock["default"],
+        )
+        with open(self._state_file + ".tmp", "w") as f:
+            json.dump(state, f, sort_keys=True)
+        os.replace(self._state_file + ".tmp", self._state_file)
+
+    def _venv_is_functional(self):
+        try:
+            self.cmd(
+                '{{component.executable}} -c "from importlib.resources import files"',
+                silent=True,
+            )
+        except CmdExecutionError:
+            return False
+        return True
+
+    def _update_incremental(self):
+        lock = self._load_lock()
+        state = self._load_state()
+        if (
+            state is None
+            or state["requires"] != lock["_meta"].get("requires", {})
+            or not self._venv_is_functional()
+        ):
+            self._rebuild()
+            self._save_state(lock)
+            return
+
+        removed, changed = diff_pipfile_locks(state["default"], lock["default"])
+        if removed:
+            batou.output.annotate(f"Uninstalling: {', '.join(removed)}")
+            self.cmd(
+                f"{self.executable} -m pip uninstall -y "
+                + " ".join(shlex.quote(name) for name in removed)
+            )
+
+        requirements = [
+            pipfile_lock_requirement(name, lock["default"][name])
+            for name in changed
+        ]
+        if None in requirements:
+            # Not pinned to a version, leave resolving that to pipenv.
+            self._sync()
+        elif requirements:
+            batou.output.annotate(f"Installing: {', '.join(changed)}")
+            requirements_file = os.path.join(
+                self.venv, "batou-changed-requirements.txt"
+            )
+            with open(requirements_file, "w") as f:
+                f.write("\n".join(requirements) + "\n")
+            self.cmd(
+                f"{self.executable} -m pip install --no-deps --require-hashes"
+                f" -r {requirements_file}"
+            )
+            os.remove(requirements_file)
+        self._save_state(lock)
+
+
+def diff_pipfile_locks(old, new):
+    """Compare two `default` sections of a `Pipfile.lock`.
+
+    Return the names of removed packages and of packages which are new or
+    whose entry changed.
+    """
+    removed = sorted(set(old) - set(new))
+    changed = sorted(name for name in new if old.get(name) != new[name])
+    return removed, changed
+
+
+def pipfile_lock_requirement(name, entry):
+    """Convert an entry of a `Pipfile.lock` into a requirements.txt line.
+
+    Return None for entries not pinned to a version (VCS, path, ...).
+    """
+    if "version" not in entry:
+        return None
+    requirement = name
+    if entry.get("extras"):
+        requirement += "[{}]".format(",".join(entry["extras"]))
+    requirement += entry["version"]
+    if entry.get("markers"):
+        requirement += f"; {entry['markers']}"
+    for hash_ in entry.get("hashes", []):
+        requirement += f" --hash={hash_}"
+    return requirement
 
 
 class VirtualEnvRequirements(Component):
@@ -62,6 +244,35 @@ class VirtualEnvRequirements(Component):
         self += VirtualEnvRequirements(
             version='2.7',
             requirements_path='/path/to/my/requirements.txt')
+
+    Shared store mode::
+
+        self += VirtualEnvRequirements(
+            version='3.12',
+            requirements_path='requirements.txt',
+            store_dir='~/.venv-store',
+            store_link='venv')
+
+    With `store_dir` set, the venv is built once in a directory below
+    `store_dir` that is named after the digest of the requirements files,
+    the Python version/executable, the ELF fix and `precompile` settings.
+    `store_link` is then symlinked to it and `self.python` points to its
+    interpreter. Other components (or environments on the same host) with
+    identical inputs reuse the venv instead of building their own.
+    Deployments building or linking venvs in the same store take turns.
+
+    As the venv is addressed by its inputs, the requirements should be fully
+    pinned: an unchanged requirements file never triggers a reinstall.
+    Files included via `-r` from a requirements file are not part of the
+    digest.
+
+    Built venvs which are not linked by any component anymore are moved to
+    the `DeploymentTrash` (which must be on the same device as `store_dir`).
+
+    To patch the ELF binaries in store mode, pass `fix_elf_env_directory`
+    instead of adding a separate `FixELFRunPath`: the store entry must not be
+    changed after it has been built. With `precompile`, the venv is compiled
+    while it is built, too.
     """
 
     version = Attribute(str, default="3.12")
@@ -79,6 +290,26 @@ class VirtualEnvRequirements(Component):
     pip_install_extra_args = Attribute(str, default="")
     """Extra arguments for `pip install`, e.g. `--no-deps`."""
 
+    store_dir = Attribute(str, default=None)
+    """Directory for content-addressed venvs shared between components."""
+
+    store_link = Attribute(str, default="venv")
+    """Symlink to the venv in `store_dir`. Only used in store mode."""
+
+    fix_elf_env_directory = Attribute(str, default=None)
+    """Store mode only: `env_directory` for running `FixELFRunPath`."""
+
+    precompile = Attribute("literal", default=False)
+    """Compile `.pyc` files of the venv and `precompile_paths` after install.
+
+    See `PrecompileBytecode`."""
+
+    precompile_paths = Attribute("list", default=[])
+
+    # Passed to `DeploymentTrash` in store mode.
+    trashdir = None
+    trash_config_file_name = Attribute(str, default="trash.nix")
+
     def configure(self):
         if isinstance(self.requirements_path, str):
             self.requirements_paths = [self.requirements_path]
@@ -87,24 +318,214 @@ class VirtualEnvRequirements(Component):
         else:
             raise RuntimeError("Needs to be either string or list")
 
-        if self.venv is None:
-            self.venv = batou.lib.python.VirtualEnv(self.version)
-        self += self.venv
+        if self.store_dir:
+            self._configure_store()
+            venv_dir = self.store_link
+        else:
+            if self.venv is None:
+                self.venv = batou.lib.python.VirtualEnv(self.version)
+            self += self.venv
+            venv_dir = self.workdir
+            self.python = os.path.join(self.workdir, self.venv.python)
+
+        self += InstallStep()
+        if self.precompile and self.store_dir:
+            # The venv itself is compiled in `_update_store`.
+            if self.precompile_paths:
+                self += PrecompileBytecode(
+                    self.precompile_paths[0],
+                    python=self.python,
+                    extra_paths=self.precompile_paths[1:],
+                )
+        elif self.precompile:
+            self += PrecompileBytecode(
+                os.path.join(venv_dir, "lib"),
+                python=self.python,
+                extra_paths=self.precompile_paths,
+            )
 
-    def verify(self):
-        self.assert_no_changes()
-        self.parent.assert_no_changes()
+    def _configure_store(self):
+        self.store_dir = self.map(self.store_dir)
+        self.store_link = self.map(self.store_link)
+        self.python = os.path.join(
+            self.store_link, "bin", f"python{self.version}"
+        )
 
-    def update(self):
-        if self.pre_run_script_path:
-            pre_run = f"source {self.pre_run_script_path} && "
+        if self.venv is not None and self.venv.executable:
+            self.executable = self.venv.executable
+        else:
+            self.executable = f"python{self.version}"
+
+        self._fix_elf = None
+        if self.fix_elf_env_directory:
+            # Prepared but not added: it runs on the store entry as part of
+            # our own update.
+            self |= FixELFRunPath(
+                path=self.store_dir, env_directory=self.fix_elf_env_directory
+            )
+            self._fix_elf = self._
+
+        self._precompile = None
+        if self.precompile:
+            # Prepared but not added: it runs on the store entry before it
+            # is complete, as part of our own update.
+            self |= PrecompileBytecode(
+                os.path.join(self.store_link, "lib"), python=self.python
+            )
+            self._precompile = self._
+
+        self += batou.lib.file.Directory(self.store_dir, leading=True)
+        self += DeploymentTrash(
+            trashdir=self.trashdir, file_name=self.trash_config_file_name
+        )
+        self.trash = self._
+
+    def verify_install(self):
+        if self.store_dir:
+            self._verify_store()
+        else:
+            self.assert_no_changes()
+            self.parent.assert_no_changes()
+
+    def _verify_store(self):
+        entry = self._store_entry()
+        if not os.path.exists(os.path.join(entry, STORE_COMPLETE_MARKER)):
+            raise batou.UpdateNeeded()
+        if not os.path.islink(self.store_link):
+            raise batou.UpdateNeeded()
+        if os.readlink(self.store_link) != entry:
+            raise batou.UpdateNeeded()
+        if self._list_store_garbage():
+            raise batou.UpdateNeeded()
+
+    def update_install(self):
+        if self.store_dir:
+            self._update_store()
         else:
-            pre_run = ""
+            for req in self.requirements_paths:
+                self._pip_install(self.venv.python, req)
+
+    def _pre_run(self):
+        if self.pre_run_script_path:
+            return f"source {self.pre_run_script_path} && "
+        return ""
+
+    def _pip_install(self, python, req):
+        self.cmd(
+            f"{self._pre_run()} {python} -m pip install {self.pip_install_extra_args} --upgrade -r {req}",
+            env=self.env,
+        )
+
+    def _store_digest(self):
+        settings = dict(
+            version=self.version,
+            executable=self.executable,
+            pip_install_extra_args=self.pip_install_extra_args,
+            pre_run_script_path=self.pre_run_script_path,
+            fix_elf=None,
+        )
+        if self._fix_elf:
+            settings["fix_elf"] = dict(
+                env_directory=self._fix_elf.env_directory,
+                glob_patterns=self._fix_elf.glob_patterns,
+                recurse_env_dir=self._fix_elf.recurse_env_dir,
+            )
+        if self._precompile:
+            settings["precompile"] = self._precompile.invalidation_mode
+        digest = hashlib.sha256(
+            json.dumps(settings, sort_keys=True).encode("utf-8")
+        )
         for req in self.requirements_paths:
-            self.cmd(
-                f"{pre_run} {self.venv.python} -m pip install {self.pip_install_extra_args} --upgrade -r {req}",
-                env=self.env,
+            try:
+                with open(req, "rb") as f:
+                    digest.update(f.read())
+            except FileNotFoundError:
+                # Likely to be created by an earlier component in this run.
+                raise batou.UpdateNeeded()
+        return digest.hexdigest()[:32]
+
+    def _store_entry(self):
+        return os.path.join(self.store_dir, self._store_digest())
+
+    def _store_ref(self):
+        link_digest = hashlib.sha256(self.store_link.encode("utf-8"))
+        return os.path.join(
+            self.store_dir, STORE_REFS, link_digest.hexdigest()[:16]
+        )
+
+    def _list_store_garbage(self):
+        """Return all complete store entries no component links to."""
+        used = set()
+        for ref in glob(os.path.join(self.store_dir, STORE_REFS, "*")):
+            try:
+                used.add(os.readlink(os.readlink(ref)))
+            except OSError:
+                # The component's link is gone.
+                continue
+        return sorted(
+            entry
+            for entry in glob(os.path.join(self.store_dir, "*"))
+            if entry not in used
+            and os.path.exists(os.path.join(entry, STORE_COMPLETE_MARKER))
+        )
+
+    def _update_store(self):
+        # Against other deployments building the same entry or collecting
+        # garbage while an entry is not linked yet.
+        with open(os.path.join(self.store_dir, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entry = self._store_entry()
+            if not os.path.exists(os.path.join(entry, STORE_COMPLETE_MARKER)):
+                self._build_store_entry(entry)
+            self._link_store_entry(entry)
+
+    def _build_store_entry(self, entry):
+        # The venv can't be built elsewhere and moved as its scripts refer
+        # to its path. Instead, it is only used once the marker exists, so
+        # anything found here is left over from an aborted build.
+        self.trash.discard(entry)
+        self.cmd(
+            f"{self._pre_run()} {self.executable} -m venv {entry}",
+            env=self.env,
+        )
+        python = os.path.join(entry, "bin", "python")
+        for req in self.requirements_paths:
+            self._pip_install(python, req)
+        if self._fix_elf:
+            self._fix_elf.path = entry
+            self._fix_elf.update()
+        if self._precompile:
+            self._precompile.paths = [os.path.join(entry, "lib")]
+            self._precompile.python = python
+            self._precompile.state_file = os.path.join(
+                entry, ".batou-precompile.json"
             )
+            self._precompile.update()
+        self.touch(os.path.join(entry, STORE_COMPLETE_MARKER))
+
+    def _link_store_entry(self, entry):
+        if os.path.isdir(self.store_link) and not os.path.islink(
+            self.store_link
+        ):
+            self.trash.discard(self.store_link)
+        tmp_link = f"{self.store_link}.tmp"
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(entry, tmp_link)
+        os.replace(tmp_link, self.store_link)
+
+        ref = self._store_ref()
+        os.makedirs(os.path.dirname(ref), exist_ok=True)
+        if os.path.lexists(ref):
+            os.remove(ref)
+        os.symlink(self.store_link, ref)
+
+        for ref in glob(os.path.join(self.store_dir, STORE_REFS, "*")):
+            if not os.path.islink(os.readlink(ref)):
+                os.remove(ref)
+        for garbage in self._list_store_garbage():
+            batou.output.annotate(f"Removing unused venv: {garbage}")
+            self.trash.discard(garbage)
 
 
 class FixELFRunPath(Component):
@@ -266,6 +687,90 @@ class FixELFRunPath(Component):
             raise CmdExecutionError(cmd, proc.returncode, stdout, stderr)
 
 
+class PrecompileBytecode(Component):
+    """Compile `.pyc` files for a venv or an application checkout in parallel.
+
+    Usage::
+
+        self += PrecompileBytecode(
+            self.checkout.prepared_path,
+            python=self.venv.python,
+            extra_paths=[self.map("scripts")])
+
+    Otherwise, Python compiles modules lazily on first import which makes
+    the first requests after a deployment slow, or even on every start if the
+    code is not writable for the user running it.
+
+    All files are compiled with hash-based invalidation (PEP 552): a `.pyc`
+    stays valid as long as the source's content does not change, so a fresh
+    checkout of an unchanged file is not compiled again. With
+    `invalidation_mode="unchecked-hash"` the interpreter does not even hash
+    the source on import, which is only safe for code that is never changed
+    in place.
+
+    `python` must be the interpreter that will import the code since the
+    bytecode format depends on the Python version. `jobs=0` uses all cores.
+
+    The mtime and size of all sources are remembered in `state_file`, so on
+    the next deployment only sources which changed since are read and hashed.
+
+    `VirtualEnvRequirements` and `Pipenv` can do this right after installing
+    by setting `precompile`.
+    """
+
+    _required_params_ = {"python": "python3"}
+    namevar = "path"
+    python = Attribute(str)
+    extra_paths = Attribute("list", default=[])
+    jobs = Attribute(int, default=0)
+    invalidation_mode = Attribute(str, default="checked-hash")
+    state_file = Attribute(str, default=None)
+
+    def configure(self):
+        if self.invalidation_mode not in ("checked-hash", "unchecked-hash"):
+            raise ValueError(
+                f"Unsupported invalidation mode: {self.invalidation_mode}"
+            )
+        self.paths = [self.map(p) for p in [self.path, *self.extra_paths]]
+        if self.state_file is None:
+            digest = hashlib.sha256("\0".join(self.paths).encode("utf-8"))
+            self.state_file = (
+                f".batou-precompile-{digest.hexdigest()[:16]}.json"
+            )
+        self.state_file = self.map(self.state_file)
+
+    def verify(self):
+        try:
+            self._compile(check=True)
+        except CmdExecutionError:
+            raise batou.UpdateNeeded()
+
+    def update(self):
+        stdout = self._compile(check=False)
+        batou.output.annotate(f"Precompiled bytecode: {stdout.strip()}")
+
+    def _compile(self, check):
+        args = ["-j", str(self.jobs)]
+        args += ["--invalidation-mode", self.invalidation_mode]
+        args += ["--state", self.state_file]
+        if check:
+            args.append("--check")
+        args.extend(self.paths)
+        # The script is passed via stdin to not clutter the workdir.
+        cmd = f"{shlex.quote(self.python)} - " + " ".join(
+            shlex.quote(arg) for arg in args
+        )
+        proc = self.cmd(cmd, communicate=False, expand=False)
+        stdout, stderr = proc.communicate(
+            input=(
+                files(__spec__.parent) / "resources/precompile.py"
+            ).read_bytes()
+        )
+        if proc.returncode != 0:
+            raise CmdExecutionError(cmd, proc.returncode, stdout, stderr)
+        return stdout.decode("utf-8")
+
+
 class BuildEnv(Component):
     """Build a (raw) python environment in NixOS.
 
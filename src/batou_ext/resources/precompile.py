@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Compile .py files to hash-based .pyc files (PEP 552) in parallel.
+
+Files with an up-to-date .pyc (same source hash and invalidation mode) are
+skipped. With --check, nothing is written and the exit code is 1 if any
+file would be compiled.
+
+With --state, the mtime and size of all sources are recorded after
+compiling. Sources whose mtime and size did not change since are not read
+again.
+
+Must be run with the interpreter that is going to import the code.
+"""
+
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import py_compile
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+MODES = {
+    "checked-hash": py_compile.PycInvalidationMode.CHECKED_HASH,
+    "unchecked-hash": py_compile.PycInvalidationMode.UNCHECKED_HASH,
+}
+# See PEP 552: bit 0 marks hash-based pycs, bit 1 the checked mode.
+FLAGS = {
+    "checked-hash": 0b11,
+    "unchecked-hash": 0b01,
+}
+
+
+def find_sources(paths):
+    for path in paths:
+        if os.path.isfile(path):
+            if path.endswith(".py"):
+                yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = [d for d in dirnames if d != "__pycache__"]
+            for filename in filenames:
+                if filename.endswith(".py"):
+                    yield os.path.join(dirpath, filename)
+
+
+def is_current(source, source_bytes, mode):
+    try:
+        with open(importlib.util.cache_from_source(source), "rb") as f:
+            header = f.read(16)
+    except OSError:
+        return False
+    return (
+        len(header) == 16
+        and header[:4] == importlib.util.MAGIC_NUMBER
+        and int.from_bytes(header[4:8], "little") == FLAGS[mode]
+        and header[8:] == importlib.util.source_hash(source_bytes)
+    )
+
+
+def stat(source):
+    try:
+        st = os.stat(source)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def load_state(path, mode):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if state.get("mode") != mode:
+        return {}
+    return state["sources"]
+
+
+def save_state(path, mode, stats):
+    with open(path + ".tmp", "w") as f:
+        json.dump({"mode": mode, "sources": stats}, f)
+    os.replace(path + ".tmp", path)
+
+
+def process(source, mode, check):
+    """Return one of "current", "stale", "compiled" or "failed"."""
+    try:
+        with open(source, "rb") as f:
+            source_bytes = f.read()
+    except OSError:
+        return "failed"
+    if is_current(source, source_bytes, mode):
+        return "current"
+    try:
+        if check:
+            # Files which don't compile at all (e.g. templates or Python 2
+            # leftovers in packages) must not count as stale forever.
+            compile(source_bytes, source, "exec", dont_inherit=True)
+            return "stale"
+        py_compile.compile(source, doraise=True, invalidation_mode=MODES[mode])
+    except (SyntaxError, ValueError, py_compile.PyCompileError, OSError):
+        return "failed"
+    return "compiled"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-j", "--jobs", type=int, default=0)
+    parser.add_argument(
+        "--invalidation-mode", choices=sorted(MODES), default="checked-hash"
+    )
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--state")
+    parser.add_argument("paths", nargs="+")
+    args = parser.parse_args()
+
+    mode = args.invalidation_mode
+    # Stat before reading: a change in between is detected next time.
+    stats = {source: stat(source) for source in find_sources(args.paths)}
+    known = load_state(args.state, mode) if args.state else {}
+    unchanged = {
+        source
+        for source, stat_ in stats.items()
+        if stat_ is not None
+        and known.get(source) == stat_
+        and os.path.exists(importlib.util.cache_from_source(source))
+    }
+    sources = [source for source in stats if source not in unchanged]
+    # `fork` explicitly: this script may be passed via stdin, so the workers
+    # cannot re-import it.
+    with ProcessPoolExecutor(
+        max_workers=args.jobs or os.cpu_count(),
+        mp_context=multiprocessing.get_context("fork"),
+    ) as pool:
+        results = list(
+            pool.map(
+                process,
+                sources,
+                [mode] * len(sources),
+                [args.check] * len(sources),
+                chunksize=64,
+            )
+        )
+
+    results += ["current"] * len(unchanged)
+    if args.state and not args.check:
+        save_state(
+            args.state,
+            mode,
+            {
+                source: stat_
+                for source, stat_ in stats.items()
+                if stat_ is not None
+            },
+        )
+
+    counts = {
+        state: results.count(state)
+        for state in ["current", "stale", "compiled", "failed"]
+    }
+    print(", ".join(f"{count} {state}" for state, count in counts.items()))
+    if args.check and counts["stale"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
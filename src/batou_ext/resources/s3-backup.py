@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""Stream the output of a shell command to S3 as a multipart upload.
+
+The command (e.g. `pg_dump ... | zstd -T0`) is run with `pipefail`. Its
+output is uploaded in parts of `--chunk-size` bytes, at most
+`--concurrency` at a time, so at most that many parts are held in memory.
+The upload is only completed if the command succeeded, otherwise it is
+aborted and no object is created.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+
+
+def read_part(stream, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+
+def upload(client, bucket, key, upload_id, stream, chunk_size, concurrency):
+    """Upload `stream` as the parts of the multipart upload `upload_id`.
+
+    Returns the parts and the number of bytes. The caller completes or
+    aborts the upload.
+    """
+    slots = threading.Semaphore(concurrency)
+    size = 0
+
+    def upload_part(number, data):
+        try:
+            response = client.upload_part(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=number,
+                Body=data,
+            )
+        finally:
+            slots.release()
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        number = 1
+        while True:
+            slots.acquire()
+            if any(f.done() and f.exception() for f in futures):
+                # Stop reading, the error is raised below.
+                break
+            data = read_part(stream, chunk_size)
+            if not data and number > 1:
+                slots.release()
+                break
+            size += len(data)
+            futures.append(pool.submit(upload_part, number, data))
+            if len(data) < chunk_size:
+                break
+            number += 1
+        parts = [future.result() for future in futures]
+    return parts, size
+
+
+def write_metrics(path, name, success, duration, size):
+    labels = f'{{name="{name}"}}'
+    lines = [
+        f"batou_backup_success{labels} {int(success)}",
+        f"batou_backup_duration_seconds{labels} {duration:.3f}",
+    ]
+    if success:
+        lines += [
+            f"batou_backup_size_bytes{labels} {size}",
+            f"batou_backup_last_success_timestamp_seconds{labels} "
+            f"{time.time():.0f}",
+        ]
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.rename(tmp, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--config", required=True, help="S3 config (JSON)")
+    parser.add_argument("--bucket", required=True)
+    parser.add_argument("--prefix", default="")
+    parser.add_argument("--suffix", default="")
+    parser.add_argument("--name", default="backup")
+    parser.add_argument("--chunk-size", type=int, default=32 * 1024 * 1024)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--metrics-file")
+    parser.add_argument("command", help="Shell command to back up")
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        config = json.load(f)
+    client = boto3.client(
+        "s3",
+        endpoint_url=config["endpoint_url"],
+        aws_access_key_id=config["access_key_id"],
+        aws_secret_access_key=config["secret_access_key"],
+        config=Config(
+            request_checksum_calculation="when_required",
+            response_checksum_validation="when_required",
+        ),
+    )
+    now = datetime.datetime.now(datetime.timezone.utc)
+    key = f"{args.prefix}{now:%Y%m%dT%H%M%SZ}{args.suffix}"
+
+    start = time.monotonic()
+    proc = subprocess.Popen(
+        ["bash", "-o", "pipefail", "-c", args.command],
+        stdout=subprocess.PIPE,
+    )
+    upload_id = None
+    success = False
+    size = 0
+    try:
+        upload_id = client.create_multipart_upload(Bucket=args.bucket, Key=key)[
+            "UploadId"
+        ]
+        parts, size = upload(
+            client,
+            args.bucket,
+            key,
+            upload_id,
+            proc.stdout,
+            args.chunk_size,
+            args.concurrency,
+        )
+        proc.stdout.close()
+        if proc.wait() != 0:
+            print(
+                f"Command failed with exit code {proc.returncode}, "
+                "aborting upload.",
+                file=sys.stderr,
+            )
+        else:
+            client.complete_multipart_upload(
+                Bucket=args.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+            success = True
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if not success and upload_id:
+            client.abort_multipart_upload(
+                Bucket=args.bucket, Key=key, UploadId=upload_id
+            )
+        duration = time.monotonic() - start
+        if args.metrics_file:
+            write_metrics(args.metrics_file, args.name, success, duration, size)
+
+    if not success:
+        return 1
+    rate = size / duration / 1024**2 if duration else 0
+    print(
+        f"Uploaded s3://{args.bucket}/{key}: {size} bytes in "
+        f"{duration:.1f}s ({rate:.1f} MiB/s)"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -16,17 +16,40 @@ To make a bucket available, to e.g. the application::
 
     self += batou_ext.s3.Bucket('downloads', s3=self.s3)
 
+To extract a tarball from a bucket without writing it to disk first::
+
+    self += batou_ext.s3.DownloadAndExtract('release-1.0.tar.gz',
+                                            bucketname='mybucket',
+                                            target='release-1.0',
+                                            s3=self.s3)
+
+To mirror a prefix of a bucket to a directory (or the other way round)::
+
+    self += batou_ext.s3.Sync('assets',
+                              bucketname='mybucket',
+                              prefix='assets/',
+                              s3=self.s3)
+
 """
 
+import concurrent.futures
+import hashlib
+import json
 import os
+import shutil
+import subprocess
+import tempfile
+import threading
 from unittest.mock import Mock
 
 import batou.component
 import batou.utils
 import boto3
+import boto3.s3.transfer
 import botocore.exceptions
 from botocore.config import Config
 
+from batou_ext.archive import finish_marker, tar_compression_args
 from batou_ext.file import SymlinkAndCleanup
 
 RGW_S3_CONFIG = Config(
@@ -35,13 +58,94 @@ RGW_S3_CONFIG = Config(
 )
 
 
+# boto3 resources by endpoint, credentials and connection settings, see
+# `get_resource`.
+_resources = {}
+_resources_lock = threading.Lock()
+
+
+def get_resource(
+    endpoint_url,
+    access_key_id,
+    secret_access_key,
+    max_pool_connections=10,
+    retry_mode=None,
+    max_attempts=None,
+):
+    """Return a boto3 S3 resource which is shared by all callers with the
+    same arguments, i.e. they share its session and connection pool.
+    """
+    key = (
+        endpoint_url,
+        access_key_id,
+        secret_access_key,
+        max_pool_connections,
+        retry_mode,
+        max_attempts,
+    )
+    with _resources_lock:
+        if key not in _resources:
+            retries = {}
+            if retry_mode:
+                retries["mode"] = retry_mode
+            if max_attempts:
+                retries["max_attempts"] = max_attempts
+            config = RGW_S3_CONFIG.merge(
+                Config(
+                    max_pool_connections=max_pool_connections,
+                    retries=retries or None,
+                )
+            )
+            session = boto3.session.Session(
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=secret_access_key,
+            )
+            _resources[key] = session.resource(
+                "s3", endpoint_url=endpoint_url, config=config
+            )
+        return _resources[key]
+
+
+class Lazy:
+    """Proxy for the object returned by `factory`, which is only called
+    when a public attribute is accessed first.
+
+    Private attributes are not proxied: batou looks for event handlers on
+    all attributes of a component when preparing it.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._obj = None
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        with self._lock:
+            if self._obj is None:
+                self._obj = self._factory()
+        return getattr(self._obj, name)
+
+
 class S3(batou.component.Component):
     """Configuration for an S3 connection and its credentials.
 
     Keyword arguments:
-    access_key_id     -- The S3 access key ID
-    secret_access_key -- The S3 secret access key
-    endpoint_url      -- The S3 enpoint's URL
+    access_key_id        -- The S3 access key ID
+    secret_access_key    -- The S3 secret access key
+    endpoint_url         -- The S3 enpoint's URL
+    max_pool_connections -- Size of the HTTP connection pool
+    retry_mode           -- botocore retry mode ("legacy", "standard" or
+                            "adaptive"), default: botocore's default
+    max_attempts         -- Maximum number of attempts per request
+
+    The boto3 resource (`client`) is only created when it is used first. It
+    is shared by all `S3` components of the deployment with the same
+    settings.
+
+    `etags` lists the ETags of all objects below a prefix of a bucket at
+    once, see the `batch_prefix` of `Download`.
     """
 
     _required_params_ = {
@@ -52,15 +156,38 @@ class S3(batou.component.Component):
     endpoint_url = batou.component.Attribute(str)
     access_key_id = batou.component.Attribute(str)
     secret_access_key = batou.component.Attribute(str)
+    max_pool_connections = batou.component.Attribute(int, default=10)
+    retry_mode = batou.component.Attribute(str, default=None)
+    max_attempts = batou.component.Attribute(int, default=None)
 
     def configure(self):
-        self.client = boto3.resource(
-            "s3",
-            aws_access_key_id=self.access_key_id,
-            aws_secret_access_key=self.secret_access_key,
-            endpoint_url=self.endpoint_url,
-            config=RGW_S3_CONFIG,
+        self.client = Lazy(
+            lambda: get_resource(
+                self.endpoint_url,
+                self.access_key_id,
+                self.secret_access_key,
+                self.max_pool_connections,
+                self.retry_mode,
+                self.max_attempts,
+            )
         )
+        self._etags = {}
+        self._etags_lock = threading.Lock()
+
+    def etags(self, bucketname, prefix=""):
+        """Return the ETags of the objects in `bucketname` whose keys start
+        with `prefix` as a dict of key: ETag.
+
+        The objects are listed once (with `ListObjectsV2`), later calls
+        return that snapshot.
+        """
+        with self._etags_lock:
+            if (bucketname, prefix) not in self._etags:
+                objects = self.client.Bucket(bucketname).objects
+                self._etags[bucketname, prefix] = {
+                    obj.key: obj.e_tag for obj in objects.filter(Prefix=prefix)
+                }
+            return self._etags[bucketname, prefix]
 
 
 class Bucket(batou.component.Component):
@@ -79,7 +206,7 @@ class Bucket(batou.component.Component):
     s3 = batou.component.Attribute()
 
     def configure(self):
-        self.bucket = self.s3.client.Bucket(self.bucketname)
+        self.bucket = Lazy(lambda: self.s3.client.Bucket(self.bucketname))
 
     def verify(self):
         try:
@@ -93,6 +220,71 @@ class Bucket(batou.component.Component):
         self.bucket.create()
 
 
+class LifecycleRule(batou.component.Component):
+    """Expire the objects below `prefix` in a bucket after
+    `expiration_days`.
+
+    Usage::
+
+        self += batou_ext.s3.LifecycleRule("expire-backups",
+                                           bucketname="backups",
+                                           prefix="db/",
+                                           expiration_days=30,
+                                           s3=self.s3)
+
+    The rule (identified by its ID) is added to the lifecycle configuration
+    of the bucket, other rules are kept. Incomplete multipart uploads below
+    the prefix are aborted after a day.
+    """
+
+    _required_params_ = {
+        "bucketname": "bucket",
+        "expiration_days": 1,
+        "s3": Mock(),
+    }
+    namevar = "id"
+    s3 = None
+    bucketname = batou.component.Attribute(str)
+    prefix = batou.component.Attribute(str, default="")
+    expiration_days = batou.component.Attribute(int)
+
+    def configure(self):
+        self.rule = {
+            "ID": self.id,
+            "Filter": {"Prefix": self.prefix},
+            "Status": "Enabled",
+            "Expiration": {"Days": self.expiration_days},
+            "AbortIncompleteMultipartUpload": {"DaysAfterInitiation": 1},
+        }
+
+    def _rules(self):
+        try:
+            return (
+                self.s3.client.meta.client.get_bucket_lifecycle_configuration(
+                    Bucket=self.bucketname
+                )["Rules"]
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchLifecycleConfiguration":
+                return []
+            raise
+
+    def verify(self):
+        for rule in self._rules():
+            if rule["ID"] == self.id:
+                if any(rule.get(k) != v for k, v in self.rule.items()):
+                    raise batou.UpdateNeeded()
+                return
+        raise batou.UpdateNeeded()
+
+    def update(self):
+        rules = [rule for rule in self._rules() if rule["ID"] != self.id]
+        rules.append(self.rule)
+        self.s3.client.meta.client.put_bucket_lifecycle_configuration(
+            Bucket=self.bucketname, LifecycleConfiguration={"Rules": rules}
+        )
+
+
 class Download(batou.component.Component):
     """
     Downloads a file from a given S3 instance.
@@ -102,6 +294,34 @@ class Download(batou.component.Component):
         self += batou_ext.s3.Download("my/file/from/bucket"
                                         s3,
                                         bucketname="mybucket")
+
+    The object is downloaded in ranges of `chunk_size` bytes, of which up
+    to `max_concurrency` are fetched in parallel, into `<target>.part`. The
+    file is moved to `target` once it is complete. An interrupted download
+    is resumed from the ranges which were completed, unless the object
+    changed in the meantime. The checksum is computed while downloading.
+
+    The checksum of the target file is cached in `<target>.checksum` and
+    only computed again if the file's inode, size or mtime change. Set
+    `paranoid` to compute it on every deployment.
+
+    Without a checksum, `verify` compares the ETag of the object to the one
+    of the last download, which costs a request per component. If many
+    objects are downloaded from the same bucket, set `batch_prefix` to a
+    common prefix of their keys: the ETags of all objects below it are
+    listed once and all components with that prefix verify against this
+    snapshot.
+
+    Pass a `batou_ext.file.ArtifactCache` as `artifact_cache` to share
+    downloads between components and environments on the host: an object
+    with the same checksum (or ETag, if no checksum is given) is only
+    downloaded once and then linked to the targets::
+
+        cache = batou_ext.file.ArtifactCache(
+            "~/.cache/artifacts", max_size=10 * 1024**3)
+        self += batou_ext.s3.Download(..., artifact_cache=cache)
+        self += batou_ext.file.SymlinkAndCleanup(
+            self._.target, pattern="*.tar.gz", artifact_cache=cache)
     """
 
     _required_params_ = {
@@ -114,48 +334,82 @@ class Download(batou.component.Component):
     key = batou.component.Attribute(str)
     bucketname = batou.component.Attribute(str)
     target = batou.component.Attribute(str)
+    max_concurrency = batou.component.Attribute(int, default=10)
+    chunk_size = batou.component.Attribute(int, default=8 * 1024 * 1024)
+    paranoid = batou.component.Attribute("literal", default=False)
+    batch_prefix = batou.component.Attribute(str, default=None)
 
     # Optional checksum. If given it is used as "must download" indicator,
     # otherwise the the file's ETAG from S3 is used.
     checksum = None
+    artifact_cache = None
 
     def configure(self):
         if self.checksum:
             self.checksum_function, self.checksum = self.checksum.split(":")
-        else:
-            self.etag_file = self.target + ".etag"
-
-        self.obj = self.s3.client.Object(self.bucketname, self.key)
+        if self.batch_prefix is not None and not self.key.startswith(
+            self.batch_prefix
+        ):
+            raise ValueError(
+                f"Key {self.key!r} does not start with the batch prefix "
+                f"{self.batch_prefix!r}."
+            )
         self.target = self.map(self.target)
+        self.etag_file = self.target + ".etag"
+        self.checksum_file = self.target + ".checksum"
+        self.obj = Lazy(
+            lambda: self.s3.client.Object(self.bucketname, self.key)
+        )
 
     def verify(self):
         if not os.path.exists(self.target):
             raise batou.UpdateNeeded()
         if self.checksum:
-            if self.checksum != batou.utils.hash(
-                self.target, self.checksum_function
-            ):
+            checksum = None if self.paranoid else self._cached_checksum()
+            if checksum is None:
+                checksum = batou.utils.hash(self.target, self.checksum_function)
+                if checksum == self.checksum and not self.paranoid:
+                    # The file is correct, only the cache is stale (e.g.
+                    # after a touch). That is no reason for an update.
+                    self._save_checksum(checksum)
+            if checksum != self.checksum:
                 raise batou.UpdateNeeded()
         else:
             if not os.path.exists(self.etag_file):
                 raise batou.UpdateNeeded()
             with open(self.etag_file) as f:
                 current_etag = f.read()
-                try:
-                    remote_etag = self.obj.e_tag
-                except botocore.exceptions.ClientError:
-                    # This usually means a 404. We'll pass the error to update
-                    # So the output actually becomes useful.
-                    raise batou.UpdateNeeded()
-                if current_etag != remote_etag:
-                    raise batou.UpdateNeeded()
+            if current_etag != self._remote_etag():
+                raise batou.UpdateNeeded()
+
+    def _remote_etag(self):
+        try:
+            if self.batch_prefix is not None:
+                return self.s3.etags(self.bucketname, self.batch_prefix).get(
+                    self.key
+                )
+            return self.obj.e_tag
+        except botocore.exceptions.ClientError:
+            # This usually means a 404. We'll pass the error to update
+            # So the output actually becomes useful.
+            return None
 
     def update(self):
-        self.obj.download_file(self.target)
+        if self.artifact_cache:
+            if self.checksum:
+                key = f"{self.checksum_function}:{self.checksum}"
+            else:
+                key = f"etag:{self.obj.e_tag}"
+            if self.artifact_cache.get(key, self.target):
+                batou.output.annotate(f"Linked {self.key} from artifact cache")
+                if self.checksum:
+                    self._save_checksum(self.checksum)
+                with open(self.etag_file, "w") as f:
+                    f.write(self.obj.e_tag)
+                return
+
+        target_checksum = self._download()
         if self.checksum:
-            target_checksum = batou.utils.hash(
-                self.target, self.checksum_function
-            )
             assert self.checksum == target_checksum, """\
 Checksum mismatch!
 expected: %s
@@ -163,5 +417,521 @@ got: %s""" % (
                 self.checksum,
                 target_checksum,
             )
+            self._save_checksum(target_checksum)
         with open(self.etag_file, "w") as f:
             f.write(self.obj.e_tag)
+        if self.artifact_cache:
+            self.artifact_cache.put(key, self.target)
+
+    def _stat_key(self):
+        stat = os.stat(self.target)
+        return {
+            "function": self.checksum_function,
+            "inode": stat.st_ino,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+
+    def _cached_checksum(self):
+        """Return the checksum from `checksum_file` if the target did not
+        change since it was saved, None otherwise."""
+        try:
+            with open(self.checksum_file) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        checksum = cached.pop("checksum", None)
+        if cached != self._stat_key():
+            return None
+        return checksum
+
+    def _save_checksum(self, checksum):
+        with open(self.checksum_file, "w") as f:
+            json.dump(dict(self._stat_key(), checksum=checksum), f)
+
+    def _download(self):
+        """Download the object to `target`.
+
+        Returns the hex digest of the file if a checksum is given.
+        """
+        self.obj.load()
+        size = self.obj.content_length
+        etag = self.obj.e_tag
+        part_file = self.target + ".part"
+        state_file = part_file + ".json"
+        chunks = -(-size // self.chunk_size)
+        state = {"etag": etag, "size": size, "chunk_size": self.chunk_size}
+        try:
+            with open(state_file) as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            previous = {}
+        done = set()
+        if os.path.exists(part_file) and all(
+            previous.get(key) == value for key, value in state.items()
+        ):
+            done.update(previous["done"])
+            batou.output.annotate(
+                f"Resuming download of {self.key}: "
+                f"{len(done)}/{chunks} chunks present."
+            )
+        lock = threading.Lock()
+
+        def save_state():
+            tmp = state_file + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(dict(state, done=sorted(done)), f)
+            os.replace(tmp, state_file)
+
+        def fetch(chunk):
+            start = chunk * self.chunk_size
+            end = min(start + self.chunk_size, size)
+            # Resources are not thread-safe, clients are.
+            body = self.obj.meta.client.get_object(
+                Bucket=self.bucketname,
+                Key=self.key,
+                Range=f"bytes={start}-{end - 1}",
+                IfMatch=etag,
+            )["Body"]
+            offset = start
+            for data in body.iter_chunks(1024 * 1024):
+                os.pwrite(fd, data, offset)
+                offset += len(data)
+            if offset != end:
+                raise IOError(
+                    f"Incomplete download of {self.key}: got {offset - start} "
+                    f"of {end - start} bytes at offset {start}."
+                )
+            with lock:
+                done.add(chunk)
+                save_state()
+
+        hasher = hashlib.new(self.checksum_function) if self.checksum else None
+        hashed = 0
+
+        def hash_completed():
+            # Hash the chunks in order, as far as they are complete. They
+            # were just written, so they are read from the page cache.
+            nonlocal hashed
+            if hasher is None:
+                return
+            while hashed < chunks:
+                with lock:
+                    if hashed not in done:
+                        return
+                start = hashed * self.chunk_size
+                end = min(start + self.chunk_size, size)
+                hasher.update(os.pread(fd, end - start, start))
+                hashed += 1
+
+        fd = os.open(part_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if not done:
+                os.ftruncate(fd, 0)
+            os.ftruncate(fd, size)
+            with concurrent.futures.ThreadPoolExecutor(
+                self.max_concurrency
+            ) as pool:
+                futures = [
+                    pool.submit(fetch, chunk)
+                    for chunk in range(chunks)
+                    if chunk not in done
+                ]
+                try:
+                    hash_completed()
+                    for future in concurrent.futures.as_completed(futures):
+                        future.result()
+                        hash_completed()
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(part_file, self.target)
+        if os.path.exists(state_file):
+            os.unlink(state_file)
+        return hasher.hexdigest() if hasher else None
+
+
+class DownloadAndExtract(batou.component.Component):
+    """Download a tarball from S3 and extract it to the directory `target`,
+    like `Download` followed by `batou_ext.archive.SingleUntar`, but in one
+    pass.
+
+    The object is streamed into `tar`, which extracts it into a temporary
+    directory next to `target`. The compression (gzip, xz, zstd or bzip2)
+    is detected from the data and decompressed with `threads` threads if
+    possible, see `SingleUntar`. Once that is complete, the directory is
+    renamed to `target` and the finish marker of `SingleUntar` is written.
+
+    The archive is written to `archive` (default: the key's base name)
+    while streaming, unless `keep_archive` is disabled. An optional
+    `checksum` is verified before the directory is moved into place.
+
+    The marker records the ETag (or the checksum, if given) of the object,
+    so the archive is extracted again if the object changes.
+    """
+
+    _required_params_ = {
+        "bucketname": "bucket",
+        "target": "target",
+        "s3": Mock(),
+    }
+    namevar = "key"
+    s3 = None
+    key = batou.component.Attribute(str)
+    bucketname = batou.component.Attribute(str)
+    target = batou.component.Attribute(str)
+    archive = batou.component.Attribute(str, default=None)
+    keep_archive = batou.component.Attribute("literal", default=True)
+    strip = batou.component.Attribute(int, default=0)
+    threads = batou.component.Attribute(int, default=0)
+    exclude = ("._*",)
+
+    # Optional checksum, e.g. `sha256:<hexdigest>`.
+    checksum = None
+
+    def configure(self):
+        if self.checksum:
+            self.checksum_function, self.checksum_value = self.checksum.split(
+                ":"
+            )
+        self.target = self.map(self.target)
+        if self.archive is None:
+            self.archive = os.path.basename(self.key)
+        self.archive = self.map(self.archive)
+        self.finish_marker = finish_marker(self.target)
+        self.obj = Lazy(
+            lambda: self.s3.client.Object(self.bucketname, self.key)
+        )
+
+    def _marker(self):
+        try:
+            with open(self.finish_marker) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def verify(self):
+        if not os.path.isdir(self.target):
+            raise batou.UpdateNeeded()
+        if self.keep_archive and not os.path.exists(self.archive):
+            raise batou.UpdateNeeded()
+        marker = self._marker()
+        if self.checksum:
+            if marker != self.checksum:
+                raise batou.UpdateNeeded()
+            return
+        try:
+            remote_etag = self.obj.e_tag
+        except botocore.exceptions.ClientError:
+            # This usually means a 404, which update reports properly.
+            raise batou.UpdateNeeded()
+        if marker != remote_etag:
+            raise batou.UpdateNeeded()
+
+    def update(self):
+        self.obj.load()
+        etag = self.obj.e_tag
+        parent = os.path.dirname(self.target)
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(
+            dir=parent, prefix=f".{os.path.basename(self.target)}.extract-"
+        )
+        archive_part = self.archive + ".part"
+        try:
+            os.chmod(tmp, 0o755)
+            digest = self._extract(etag, tmp, archive_part)
+            if self.checksum:
+                assert self.checksum_value == digest, """\
+Checksum mismatch!
+expected: %s
+got: %s""" % (
+                    self.checksum_value,
+                    digest,
+                )
+            if self.keep_archive:
+                os.replace(archive_part, self.archive)
+            if os.path.exists(self.target):
+                old = tmp + ".old"
+                os.rename(self.target, old)
+                os.rename(tmp, self.target)
+                shutil.rmtree(old)
+            else:
+                os.rename(tmp, self.target)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if os.path.exists(archive_part):
+                os.unlink(archive_part)
+            raise
+        self.touch(self.target)
+        with open(self.finish_marker, "w") as f:
+            f.write(self.checksum or etag)
+
+    def _extract(self, etag, directory, archive_part):
+        """Stream the object into `tar` extracting to `directory`.
+
+        Returns the hex digest of the object if a checksum is given.
+        """
+        hasher = hashlib.new(self.checksum_function) if self.checksum else None
+        body = self.obj.get(IfMatch=etag)["Body"]
+        chunks = body.iter_chunks(1024 * 1024)
+        head = next(chunks, b"")
+        archive = open(archive_part, "wb") if self.keep_archive else None
+        args = ["tar", "-x", "-C", directory]
+        args += tar_compression_args(head, self.threads)
+        args += [f"--strip-components={self.strip}"]
+        args += [f"--exclude={x}" for x in self.exclude]
+        with tempfile.TemporaryFile() as stderr:
+            tar = subprocess.Popen(args, stdin=subprocess.PIPE, stderr=stderr)
+            try:
+                data = head
+                while data:
+                    if hasher:
+                        hasher.update(data)
+                    if archive:
+                        archive.write(data)
+                    tar.stdin.write(data)
+                    data = next(chunks, b"")
+            except BrokenPipeError:
+                # tar failed, its error is reported below.
+                pass
+            finally:
+                if archive:
+                    archive.close()
+                try:
+                    tar.stdin.close()
+                except BrokenPipeError:
+                    pass
+                tar.wait()
+            if tar.returncode:
+                stderr.seek(0)
+                raise RuntimeError(
+                    f"Extracting {self.key} failed: "
+                    + stderr.read().decode("utf-8", "replace")
+                )
+        return hasher.hexdigest() if hasher else None
+
+
+class Sync(batou.component.Component):
+    """Mirror the objects below `prefix` in an S3 bucket to the local
+    directory `path` (`direction="download"`) or the files in `path` to
+    `prefix` (`direction="upload"`).
+
+    Usage::
+
+        self += batou_ext.s3.Sync("assets",
+                                  s3=self.s3,
+                                  bucketname="releases",
+                                  prefix="myapp/1.0/assets/")
+
+    The ETag, size and mtime of every transferred file are recorded in a
+    manifest (`<path>.s3sync.json` by default). A file is transferred if
+    the object's ETag or the local file's size or mtime differ from the
+    manifest, so unchanged files are neither downloaded nor hashed. Up to
+    `max_concurrency` files are transferred in parallel, files larger than
+    `chunk_size` are uploaded in multiple parts.
+
+    Files (or objects) which are not present on the other side are kept
+    unless `delete` is set.
+    """
+
+    _required_params_ = {
+        "bucketname": "bucket",
+        "s3": Mock(),
+    }
+    namevar = "path"
+    s3 = None
+    bucketname = batou.component.Attribute(str)
+    prefix = batou.component.Attribute(str, default="")
+    direction = batou.component.Attribute(str, default="download")
+    delete = batou.component.Attribute("literal", default=False)
+    manifest = batou.component.Attribute(str, default=None)
+    max_concurrency = batou.component.Attribute(int, default=10)
+    chunk_size = batou.component.Attribute(int, default=8 * 1024 * 1024)
+
+    def configure(self):
+        if self.direction not in ("download", "upload"):
+            raise ValueError(
+                f"Unknown direction {self.direction!r}, expected 'download' "
+                "or 'upload'."
+            )
+        self.path = self.map(self.path)
+        if self.manifest is None:
+            self.manifest = self.path.rstrip("/") + ".s3sync.json"
+        self.manifest = self.map(self.manifest)
+
+    def verify(self):
+        transfer, delete, _ = self._plan()
+        if transfer or delete:
+            raise batou.UpdateNeeded()
+
+    def update(self):
+        transfer, delete, remote = self._plan()
+        manifest = self._read_manifest()
+        if self.direction == "download":
+            self._download(transfer, delete, remote, manifest)
+        else:
+            self._upload(transfer, delete, manifest)
+        self._write_manifest(manifest)
+
+    def _key(self, name):
+        return self.prefix + name
+
+    def _local_path(self, name):
+        path = os.path.normpath(os.path.join(self.path, name))
+        if not path.startswith(os.path.join(self.path, "")):
+            raise ValueError(
+                f"Object {self._key(name)!r} is outside of {self.path!r}."
+            )
+        return path
+
+    def _list_remote(self):
+        """Return the objects below `prefix` as a dict of name: ETag."""
+        objects = self.s3.client.Bucket(self.bucketname).objects
+        return {
+            obj.key[len(self.prefix) :]: obj.e_tag
+            for obj in objects.filter(Prefix=self.prefix)
+            if not obj.key.endswith("/")
+        }
+
+    def _list_local(self):
+        """Return the files in `path` as a dict of name: (size, mtime)."""
+        files = {}
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                filename = os.path.join(dirpath, filename)
+                stat = os.stat(filename)
+                name = os.path.relpath(filename, self.path)
+                files[name.replace(os.sep, "/")] = (
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                )
+        return files
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_manifest(self, manifest):
+        tmp = self.manifest + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, sort_keys=True)
+        os.replace(tmp, self.manifest)
+
+    def _plan(self):
+        """Return the names to transfer, the names to delete and the remote
+        objects.
+        """
+        remote = self._list_remote()
+        local = self._list_local()
+        manifest = self._read_manifest()
+
+        def unchanged(name):
+            entry = manifest.get(name)
+            return (
+                entry is not None
+                and name in remote
+                and name in local
+                and entry["etag"] == remote[name]
+                and (entry["size"], entry["mtime_ns"]) == local[name]
+            )
+
+        if self.direction == "download":
+            for name in remote:
+                self._local_path(name)
+        source, target = (
+            (remote, local) if self.direction == "download" else (local, remote)
+        )
+        transfer = sorted(name for name in source if not unchanged(name))
+        delete = []
+        if self.delete:
+            delete = sorted(name for name in target if name not in source)
+        return transfer, delete, remote
+
+    def _transfer(self, func, names):
+        with concurrent.futures.ThreadPoolExecutor(
+            self.max_concurrency
+        ) as pool:
+            futures = [pool.submit(func, name) for name in names]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def _record(self, manifest, name, etag):
+        stat = os.stat(os.path.join(self.path, name))
+        manifest[name] = {
+            "etag": etag,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+
+    def _download(self, transfer, delete, remote, manifest):
+        bucket = self.s3.client.Bucket(self.bucketname)
+        # The pool bounds the concurrency.
+        config = boto3.s3.transfer.TransferConfig(use_threads=False)
+
+        def download(name):
+            target = self._local_path(name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # Written to a temporary file which is then renamed.
+            bucket.download_file(self._key(name), target, Config=config)
+            batou.output.annotate(f"Downloaded {name}")
+
+        self._transfer(download, transfer)
+        for name in transfer:
+            self._record(manifest, name, remote[name])
+
+        for name in delete:
+            batou.output.annotate(f"Removing {name}")
+            os.unlink(os.path.join(self.path, name))
+            manifest.pop(name, None)
+        # Remove directories which became empty.
+        for dirpath, _, _ in os.walk(self.path, topdown=False):
+            if dirpath != self.path and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+
+    def _upload(self, transfer, delete, manifest):
+        bucket = self.s3.client.Bucket(self.bucketname)
+        # The pool bounds the concurrency, so parts of a multipart upload
+        # are sent one after another.
+        config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=self.chunk_size,
+            multipart_chunksize=self.chunk_size,
+            use_threads=False,
+        )
+
+        def upload(name):
+            bucket.upload_file(
+                os.path.join(self.path, name), self._key(name), Config=config
+            )
+            batou.output.annotate(f"Uploaded {name}")
+
+        self._transfer(upload, transfer)
+
+        for start in range(0, len(delete), 1000):
+            batch = delete[start : start + 1000]
+            for name in batch:
+                batou.output.annotate(f"Removing {self._key(name)}")
+            bucket.delete_objects(
+                Delete={
+                    "Objects": [{"Key": self._key(name)} for name in batch],
+                    "Quiet": True,
+                }
+            )
+        for name in delete:
+            manifest.pop(name, None)
+
+        # The ETags of the uploaded objects are only known to S3.
+        remote = self._list_remote()
+        for name in transfer:
+            self._record(manifest, name, remote[name])
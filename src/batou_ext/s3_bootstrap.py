@@ -1,11 +1,17 @@
+import argparse
+import atexit
+import concurrent.futures
 import json
 import shlex
+import shutil
 import subprocess
+import tempfile
 from os import environ
 from sys import exit
 from typing import Dict, List, Union
 
 import boto3
+import yaml
 from InquirerPy import inquirer
 
 
@@ -23,11 +29,33 @@ def print_bold(msg):
     print(ANSIColors.BOLD + str(msg) + ANSIColors.ENDC)
 
 
+_ssh_control_dir = None
+
+
+def ssh_options() -> List[str]:
+    """Options to share one SSH connection per host between all calls of
+    `remote_sudo`. The master connection is closed a minute after the
+    last call.
+    """
+    global _ssh_control_dir
+    if _ssh_control_dir is None:
+        _ssh_control_dir = tempfile.mkdtemp(prefix="s3_bootstrap-ssh-")
+        atexit.register(shutil.rmtree, _ssh_control_dir, ignore_errors=True)
+    return [
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        f"ControlPath={_ssh_control_dir}/%C",
+        "-o",
+        "ControlPersist=60",
+    ]
+
+
 def remote_sudo(host: str, password: str, cmd: List[str]) -> str:
     cmd_ = " ".join(shlex.quote(x) for x in cmd)
     print_bold(f"[{host}]$ sudo -S {cmd_}")
     proc = subprocess.Popen(
-        ["ssh", host, f"sudo -S {cmd_}"],
+        ["ssh", *ssh_options(), host, f"sudo -S {cmd_}"],
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
@@ -64,7 +92,10 @@ class Step:
 
 
 class Plan:
-    steps: List[Step] = []
+    steps: List[Step]
+
+    def __init__(self):
+        self.steps = []
 
     def __add__(self, step: Step):
         self.steps.append(step)
@@ -73,8 +104,7 @@ class Plan:
     def __str__(self) -> str:
         return "\n".join(f" - {str(s)}" for s in self.steps)
 
-    def apply(self):
-        previous_result = None
+    def apply(self, previous_result=None):
         for step in self.steps:
             try:
                 step.verify(previous_result)
@@ -87,6 +117,7 @@ class Plan:
                 print_bold("Aborting")
                 exit(1)
             previous_result = step.apply(previous_result)
+        return previous_result
 
 
 class StateAlreadyExists(Exception):
@@ -170,6 +201,7 @@ class CreateKeypair(Step):
             data["keys"][-1]["access_key"], data["keys"][-1]["secret_key"]
         )
 
+        print(f"# RG {self.rg_name}")
         print(f"AWS_ACCESS_KEY_ID={kp.key_id}")
         print(f"AWS_SECRET_ACCESS_KEY={kp.secret_key}")
 
@@ -189,8 +221,11 @@ class CreateBucket(Step):
         if key is not None:
             kwargs["aws_access_key_id"] = key.key_id
             kwargs["aws_secret_access_key"] = key.secret_key
-        self.resource = boto3.resource("s3", **kwargs)
-        self.client = boto3.client("s3", **kwargs)
+        # Buckets may be created concurrently and the default session is
+        # not thread-safe.
+        session = boto3.session.Session()
+        self.resource = session.resource("s3", **kwargs)
+        self.client = session.client("s3", **kwargs)
 
         self.bucket = self.resource.Bucket(self.name)
         if self.bucket.creation_date:
@@ -204,7 +239,10 @@ class CreateBucket(Step):
 
 
 class Rules:
-    rules: Dict[str, int] = {}
+    rules: Dict[str, int]
+
+    def __init__(self):
+        self.rules = {}
 
     def __iter__(self):
         return iter(self.rules.items())
@@ -330,9 +368,147 @@ def run():
         print("Abort. Nothing changed.")
 
 
+def read_plan_file(path: str, sudo_password=None):
+    """Read a plan file (YAML or JSON) and return the plans for the
+    accounts and the plans for their buckets::
+
+        host: cephosd.example.com  # to call radosgw-admin on
+        accounts:
+          - rg: myrg
+            create: true           # create the S3 account of the RG
+            keypair: true          # generate a keypair for it
+            buckets:
+              - name: mybucket
+                lifecycle:
+                  - prefix: logs/
+                    days: 30
+
+    The bucket plans are mapped to their account, as they need the account's
+    keypair (if one is generated, otherwise the keypair is taken from the
+    environment).
+    """
+    with open(path) as f:
+        spec = yaml.safe_load(f)
+
+    account_plans = []
+    bucket_plans = {}
+    for account in spec.get("accounts", []):
+        rg_name = account["rg"]
+        plan = Plan()
+        if account.get("create") or account.get("keypair"):
+            if "host" not in spec:
+                raise ConfigurationError(
+                    "The plan file needs a `host` to call radosgw-admin."
+                )
+            if sudo_password is None:
+                sudo_password = (
+                    environ.get("S3_BOOTSTRAP_SUDO_PASSWORD")
+                    or ask_sudo_password()
+                )
+        if account.get("create"):
+            plan += CreateS3Account(rg_name, sudo_password, spec["host"])
+        if account.get("create") or account.get("keypair"):
+            plan += CreateKeypair(rg_name, sudo_password, spec["host"])
+        elif not all(
+            x in environ for x in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"]
+        ):
+            raise ConfigurationError(
+                f"No keypair for {rg_name}: "
+                "AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY missing from "
+                "environment"
+            )
+        account_plans.append(plan)
+
+        bucket_plans[plan] = []
+        for bucket in account.get("buckets", []):
+            bucket_plan = Plan()
+            bucket_plan += CreateBucket(bucket["name"])
+            rules = Rules()
+            for rule in bucket.get("lifecycle", []):
+                rules.add(rule["prefix"].lstrip("/"), int(rule["days"]))
+            if len(rules) > 0:
+                bucket_plan += CreateLifecyclePolicyConfiguration(
+                    bucket["name"], rules
+                )
+            bucket_plans[plan].append(bucket_plan)
+    return account_plans, bucket_plans
+
+
+def run_plan_file(path: str, jobs: int = 4, yes: bool = False):
+    """Apply the plan file `path`.
+
+    The planned steps are shown and have to be confirmed, unless `yes` is
+    given (`--yes`).
+
+    The accounts are set up concurrently, then all buckets are created
+    and get their lifecycle rules concurrently.
+    """
+    account_plans, bucket_plans = read_plan_file(path)
+
+    print_bold("Would perform the following steps:")
+    for plan in account_plans:
+        for p in [plan] + bucket_plans[plan]:
+            if p.steps:
+                print(p)
+    if not yes and not inquirer.confirm(message="Does this look OK?").execute():
+        print("Abort. Nothing changed.")
+        return
+
+    failed = False
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        keypairs = {plan: pool.submit(plan.apply) for plan in account_plans}
+        futures = {}
+        for plan, keypair in keypairs.items():
+            try:
+                keypair = keypair.result()
+            except (Exception, SystemExit) as e:
+                error(e)
+                failed = True
+                continue
+            for bucket_plan in bucket_plans[plan]:
+                futures[pool.submit(bucket_plan.apply, keypair)] = bucket_plan
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except (Exception, SystemExit) as e:
+                error(f"{futures[future].steps[0]} failed: {e}")
+                failed = True
+    if failed:
+        exit(1)
+
+
 def main():
+    parser = argparse.ArgumentParser(
+        description="Create S3 accounts, keypairs and buckets."
+    )
+    parser.add_argument(
+        "plan_file",
+        nargs="?",
+        help="Create what is listed in this YAML/JSON file instead of "
+        "asking interactively.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="Number of steps to run concurrently (plan file only)",
+    )
+    parser.add_argument(
+        "-y",
+        "--yes",
+        action="store_true",
+        help="Do not ask for confirmation (plan file only)",
+    )
+    args = parser.parse_args()
     try:
-        run()
+        if args.plan_file:
+            run_plan_file(args.plan_file, args.jobs, args.yes)
+        else:
+            run()
+    except ConfigurationError as e:
+        error(e)
+        exit(1)
     except KeyboardInterrupt:
         print("Interrupt")
         exit(130)
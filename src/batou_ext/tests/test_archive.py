@@ -0,0 +1,62 @@
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+
+import pytest
+
+import batou_ext.archive
+from batou_ext.archive import SingleUntar, tar_compression_args
+
+
+def test_tar_compression_args_prefer_parallel_decompressors(monkeypatch):
+    installed = {"pigz", "zstd"}
+    monkeypatch.setattr(
+        batou_ext.archive.shutil,
+        "which",
+        lambda name: f"/bin/{name}" if name in installed else None,
+    )
+    monkeypatch.setattr(batou_ext.archive.os, "cpu_count", lambda: 8)
+    gzip = b"\x1f\x8b\x08\x00"
+    zstd = b"\x28\xb5\x2f\xfd"
+    bzip2 = b"BZh91AY"
+    assert tar_compression_args(gzip) == ["--gzip"]
+    assert tar_compression_args(gzip, 0) == ["--use-compress-program=pigz -p 8"]
+    assert tar_compression_args(zstd, 2) == ["--use-compress-program=zstd -T2"]
+    assert tar_compression_args(bzip2, 2) == ["--bzip2"]
+    assert tar_compression_args(b"release/", 2) == []
+
+
+@pytest.mark.parametrize("suffix", [".tar.gz", ".tar.xz", ".tar.zst"])
+def test_single_untar(root, suffix):
+    if suffix == ".tar.zst" and not shutil.which("zstd"):
+        pytest.skip("requires zstd")
+    mode = {".tar.gz": "w:gz", ".tar.xz": "w:xz", ".tar.zst": "w"}[suffix]
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as tar:
+        info = tarfile.TarInfo("release/app.py")
+        info.size = 3
+        tar.addfile(info, io.BytesIO(b"app"))
+    data = buffer.getvalue()
+    archive = os.path.join(root.workdir, f"release{suffix}")
+    if suffix == ".tar.zst":
+        data = subprocess.run(
+            ["zstd", "-q", "-c"], input=data, capture_output=True, check=True
+        ).stdout
+    with open(archive, "wb") as f:
+        f.write(data)
+
+    untar = SingleUntar(archive, target="release", strip=1)
+    untar.prepare(root)
+    untar.threads = 2
+    untar.deploy()
+    assert untar.changed
+    with open(os.path.join(untar.target, "app.py")) as f:
+        assert f.read() == "app"
+    untar.verify()
+
+
+def test_single_untar_derives_target_of_zstd_archives():
+    assert SingleUntar.extract_base_name("release.tar.zst") == "release"
+    assert SingleUntar.extract_base_name("release.tzst") == "release"
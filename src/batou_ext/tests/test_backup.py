@@ -0,0 +1,121 @@
+import importlib.util
+import json
+import os
+from unittest import mock
+
+import boto3
+import pytest
+
+import batou_ext.postgres
+from batou_ext.backup import S3Backup
+from batou_ext.s3 import LifecycleRule
+
+
+@pytest.fixture
+def script():
+    path = os.path.join(
+        os.path.dirname(batou_ext.postgres.__file__), "resources/s3-backup.py"
+    )
+    spec = importlib.util.spec_from_file_location("s3_backup", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def bucket(tmpdir):
+    moto = pytest.importorskip("moto")
+    with moto.mock_aws():
+        client = boto3.client(
+            "s3",
+            endpoint_url="https://s3.amazonaws.com",
+            aws_access_key_id="id",
+            aws_secret_access_key="secret",
+        )
+        client.create_bucket(Bucket="backups")
+        config = tmpdir / "s3.json"
+        config.write_text(
+            json.dumps(
+                {
+                    "endpoint_url": "https://s3.amazonaws.com",
+                    "access_key_id": "id",
+                    "secret_access_key": "secret",
+                }
+            ),
+            encoding="UTF-8",
+        )
+        yield client, str(config)
+
+
+def backup(script, config, command, tmpdir):
+    return script.main(
+        [
+            f"--config={config}",
+            "--bucket=backups",
+            "--prefix=db/",
+            "--suffix=.gz",
+            "--name=db",
+            f"--chunk-size={5 * 2**20}",
+            "--concurrency=2",
+            f"--metrics-file={tmpdir / 'backup.prom'}",
+            command,
+        ]
+    )
+
+
+def test_backup_streams_in_parts(script, bucket, tmpdir, capsys):
+    client, config = bucket
+    assert backup(script, config, "head -c 11534336 /dev/zero", tmpdir) == 0
+
+    (obj,) = client.list_objects_v2(Bucket="backups")["Contents"]
+    assert obj["Key"].startswith("db/")
+    assert obj["Key"].endswith(".gz")
+    assert obj["Size"] == 11534336
+    assert obj["ETag"].endswith('-3"')
+    assert "Uploaded s3://backups/db/" in capsys.readouterr().out
+    metrics = (tmpdir / "backup.prom").read_text(encoding="UTF-8")
+    assert 'batou_backup_success{name="db"} 1' in metrics
+    assert 'batou_backup_size_bytes{name="db"} 11534336' in metrics
+
+
+def test_backup_aborts_upload_if_command_fails(script, bucket, tmpdir):
+    client, config = bucket
+    assert backup(script, config, "echo partial; false | cat", tmpdir) == 1
+
+    assert "Contents" not in client.list_objects_v2(Bucket="backups")
+    assert "Uploads" not in client.list_multipart_uploads(Bucket="backups")
+    metrics = (tmpdir / "backup.prom").read_text(encoding="UTF-8")
+    assert 'batou_backup_success{name="db"} 0' in metrics
+
+
+def test_backup_of_postgres_db(root):
+    db = batou_ext.postgres.DB("my db", owner="me")
+    db.prepare(root)
+    s3 = mock.Mock(endpoint_url="u", access_key_id="i", secret_access_key="s")
+    component = S3Backup(
+        "mydb",
+        database=db,
+        s3=s3,
+        bucketname="backups",
+        retention_days=30,
+        python="/usr/bin/python3",
+    )
+    component.prepare(root)
+    assert (
+        "'sudo -u postgres pg_dump --format=custom --compress=0 '\"'\"'my db"
+        "'\"'\"' | zstd -T0 -q'" in component.command
+    )
+    assert "--prefix=mydb/" in component.command
+    (rule,) = [
+        c for c in component.sub_components if isinstance(c, LifecycleRule)
+    ]
+    assert rule.rule["Expiration"] == {"Days": 30}
+    assert rule.rule["Filter"] == {"Prefix": "mydb/"}
+
+
+def test_backup_needs_dump_command(root):
+    component = S3Backup(
+        "other", database=object(), s3=mock.Mock(), bucketname="backups"
+    )
+    with pytest.raises(ValueError, match="dump_command"):
+        component.prepare(root)
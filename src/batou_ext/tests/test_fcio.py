@@ -734,3 +734,209 @@ class TestProvisionUpdateFromLive:
             captured = capsys.readouterr()
             assert "Hosts in config but not in live data" in captured.err
             assert "testhost02" in captured.err
+
+
+class TestDNSAliasesWait:
+    """Tests for waiting for DNS aliases."""
+
+    def test_only_pending_aliases_are_resolved_again(self):
+        aliases = fcio.DNSAliases(project="demo")
+        aliases.wait_for_aliases = 60
+        aliases.aliases = ["a", "b"]
+        attempts = {}
+
+        def getaddrinfo(fqdn, *args):
+            attempts[fqdn] = attempts.get(fqdn, 0) + 1
+            if fqdn == "b.demo.fcio.net" and attempts[fqdn] < 3:
+                raise fcio.socket.gaierror("not yet")
+            return [(None, None, None, "", ("192.0.2.1", 0))]
+
+        with patch("socket.getaddrinfo", side_effect=getaddrinfo):
+            with patch("time.sleep") as sleep:
+                aliases._wait_for_aliases()
+
+        assert attempts == {"a.demo.fcio.net": 1, "b.demo.fcio.net": 3}
+        assert [c.args[0] for c in sleep.call_args_list] == [1, 2]
+
+    def test_timeout(self):
+        aliases = fcio.DNSAliases(project="demo")
+        aliases.wait_for_aliases = 3
+        aliases.aliases = ["a"]
+        with patch(
+            "socket.getaddrinfo", side_effect=fcio.socket.gaierror("no")
+        ):
+            with patch("time.monotonic", side_effect=[0, 0, 1, 4]):
+                with patch("time.sleep") as sleep:
+                    with pytest.raises(RuntimeError):
+                        aliases._wait_for_aliases()
+        assert [c.args[0] for c in sleep.call_args_list] == [1, 2]
+
+
+class TestDeltaApply:
+    """Tests for only applying changed calls."""
+
+    def test_applied_state(self, tmp_path):
+        vm1 = {"__type__": "virtualmachine", "name": "vm1", "cores": 1}
+        vm2 = {"__type__": "virtualmachine", "name": "vm2", "cores": 1}
+        state = fcio.AppliedState(str(tmp_path / "state.json"), "provision")
+        assert state.changed([vm1, vm2]) == [vm1, vm2]
+        state.save([vm1, vm2])
+
+        state = fcio.AppliedState(str(tmp_path / "state.json"), "provision")
+        assert state.changed([vm1, vm2]) == []
+        assert state.changed([vm1, dict(vm2, cores=2)]) == [dict(vm2, cores=2)]
+        # Differences to the live data win over the local state.
+        assert state.changed([vm1, vm2], {fcio.call_key(vm1)}) == [vm1]
+
+        other = fcio.AppliedState(str(tmp_path / "state.json"), "other")
+        assert other.changed([vm1]) == [vm1]
+
+    def test_provision_applies_only_changed_vms(
+        self, tmp_path, mock_environment, capsys
+    ):
+        host = Mock()
+        host.name = "testhost01"
+        host.data = {"cores": "2", "disk": "30", "ram": "4", "roles": "web"}
+        mock_environment.hosts = {"testhost01": host}
+        mock_environment.workdir_base = str(tmp_path)
+
+        api = Mock()
+        api.query.side_effect = fcio.xmlrpc.client.Fault(1, "denied")
+        provision = fcio.Provision(env_name="testenv", dry_run=False)
+        with patch.object(provision, "load_env", return_value=mock_environment):
+            with patch.object(provision, "get_api", return_value=api):
+                provision.apply()
+                assert len(api.apply.call_args.args[0]) == 2
+
+                api.apply.reset_mock()
+                provision.apply()
+                api.apply.assert_not_called()
+                assert (
+                    "skipped: testuser, testhost01" in capsys.readouterr().out
+                )
+
+                host.data["cores"] = "4"
+                provision.apply()
+                (call,) = api.apply.call_args.args[0]
+                assert call["name"] == "testhost01"
+                assert call["cores"] == 4
+
+                provision.force = True
+                provision.apply()
+                assert len(api.apply.call_args.args[0]) == 2
+
+    def test_provision_skips_vms_matching_live_data(
+        self, tmp_path, mock_environment
+    ):
+        host = Mock()
+        host.name = "testhost01"
+        host.data = {"cores": "2", "disk": "30", "ram": "4", "roles": "web"}
+        mock_environment.hosts = {"testhost01": host}
+        mock_environment.workdir_base = str(tmp_path)
+
+        live = {
+            "name": "testhost01",
+            "cores": 2,
+            "disk": 30,
+            "memory": 4096,
+            "classes": ["role::generic", "role::web"],
+            "rbd_pool": "rbd.hdd",
+            "service_description": "",
+        }
+        api = Mock()
+        api.query.side_effect = lambda type_: [dict(live)]
+        provision = fcio.Provision(env_name="testenv", dry_run=False)
+        with patch.object(provision, "load_env", return_value=mock_environment):
+            with patch.object(provision, "get_api", return_value=api):
+                provision.apply()
+                assert len(api.apply.call_args.args[0]) == 2
+
+                api.apply.reset_mock()
+                provision.apply()
+                api.apply.assert_not_called()
+
+                # Changed outside of the deployment.
+                live["cores"] = 1
+                provision.apply()
+                (call,) = api.apply.call_args.args[0]
+                assert call["name"] == "testhost01"
+
+
+class TestMultipleEnvironments:
+    """Tests for handling several environments in one CLI run."""
+
+    def test_expand_environments(self, tmp_path, monkeypatch):
+        for name in ["dev", "prod-a", "prod-b"]:
+            (tmp_path / "environments" / name).mkdir(parents=True)
+            (tmp_path / "environments" / name / "environment.cfg").touch()
+        monkeypatch.chdir(tmp_path)
+        assert fcio.expand_environments(["prod-*", "dev", "prod-a"]) == [
+            "prod-a",
+            "prod-b",
+            "dev",
+        ]
+        with pytest.raises(ValueError):
+            fcio.expand_environments(["test"])
+
+    def test_run_provision_shares_vm_query(self, mock_environment, capsys):
+        host = Mock()
+        host.name = "testhost01"
+        host.data = {"cores": "2", "disk": "30", "ram": "4", "roles": "web"}
+        mock_environment.hosts = {"testhost01": host}
+
+        api = Mock()
+        api.query.return_value = [
+            {"name": "testhost01", "cores": 1, "classes": ["role::generic"]}
+        ]
+        with patch(
+            "batou_ext.fcio.expand_environments",
+            return_value=["prod-a", "prod-b"],
+        ):
+            with patch.object(
+                fcio.Provision, "load_env", return_value=mock_environment
+            ):
+                with patch.object(fcio.Provision, "get_api", return_value=api):
+                    fcio.run_provision(
+                        ["prod-*"], fcio.Provision.apply, diff=True
+                    )
+
+        api.query.assert_called_once_with("virtualmachine")
+        out = capsys.readouterr().out
+        assert out.index("=== prod-a ===") < out.index("=== prod-b ===")
+        assert out.count("cores               : 1 → 2") == 2
+
+
+class TestMaintenance:
+    """Tests for changing the maintenance state of resource groups."""
+
+    def test_change_maintenance_state(self):
+        api = Mock()
+        api.query.return_value = [
+            {"name": "other", "in_maintenance": True},
+            {"name": "test", "in_maintenance": False},
+        ]
+        assert fcio.change_maintenance_state(api, "test", True)
+        api.apply.assert_called_once_with(
+            [
+                {
+                    "__type__": "resourcegroup",
+                    "in_maintenance": True,
+                    "name": "test",
+                }
+            ]
+        )
+        api.apply.reset_mock()
+        assert not fcio.change_maintenance_state(api, "test", True)
+        assert not fcio.change_maintenance_state(api, "other", True)
+        api.apply.assert_not_called()
+        assert fcio.change_maintenance_state(
+            api, "test", False, predict_only=True
+        )
+        api.apply.assert_not_called()
+        api.query.assert_called_once_with("resourcegroup")
+
+    def test_unknown_resource_group(self):
+        api = Mock()
+        api.query.return_value = []
+        with pytest.raises(ValueError):
+            fcio.change_maintenance_state(api, "test", True)
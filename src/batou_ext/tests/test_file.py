@@ -0,0 +1,114 @@
+import os
+import shutil
+
+import batou
+import pytest
+
+from batou_ext.file import (
+    ArtifactCache,
+    HardlinkSyncDirectory,
+    SymlinkAndCleanup,
+)
+
+
+@pytest.mark.skipif(not shutil.which("rsync"), reason="requires rsync")
+def test_hardlink_sync_directory_links_unchanged_files(root, tmpdir):
+    source = tmpdir / "source"
+    source.mkdir()
+    (source / "unchanged.txt").write_text("same", encoding="UTF-8")
+    (source / "changed.txt").write_text("old", encoding="UTF-8")
+
+    first = HardlinkSyncDirectory(str(tmpdir / "first"), source=str(source))
+    first.prepare(root)
+    first.update()
+    os.symlink(str(tmpdir / "first"), str(tmpdir / "current"))
+
+    (source / "changed.txt").write_text("new!", encoding="UTF-8")
+    second = HardlinkSyncDirectory(
+        str(tmpdir / "second"),
+        source=str(source),
+        link_dest=str(tmpdir / "current"),
+    )
+    second.prepare(root)
+    with pytest.raises(batou.UpdateNeeded):
+        second.verify()
+    second.update()
+    second.verify()
+
+    def inode(path):
+        return os.stat(str(path)).st_ino
+
+    assert inode(tmpdir / "first" / "unchanged.txt") == inode(
+        tmpdir / "second" / "unchanged.txt"
+    )
+    assert inode(tmpdir / "first" / "changed.txt") != inode(
+        tmpdir / "second" / "changed.txt"
+    )
+    assert (tmpdir / "first" / "changed.txt").read_text("UTF-8") == "old"
+    assert (tmpdir / "second" / "changed.txt").read_text("UTF-8") == "new!"
+
+
+def test_symlink_and_cleanup_keeps_sidecars_of_targets(root, tmpdir):
+    suffixes = ["", ".etag", ".checksum", ".part", ".part.json"]
+    for version in ["v1", "v2", "v3"]:
+        for suffix in suffixes:
+            (tmpdir / f"{version}.tar.gz{suffix}").write_text("", "UTF-8")
+    os.symlink("v2.tar.gz", str(tmpdir / "current"))
+    os.symlink("v1.tar.gz", str(tmpdir / "last"))
+
+    cleanup = SymlinkAndCleanup(str(tmpdir / "v3.tar.gz"), pattern="*.tar.gz")
+    cleanup.prepare(root)
+    with cleanup.chdir(cleanup.dir):
+        assert cleanup._list_removals() == sorted(
+            f"v1.tar.gz{suffix}" for suffix in suffixes
+        )
+
+
+def test_artifact_cache_links_and_evicts_unused_artifacts(tmpdir):
+    cache = ArtifactCache(str(tmpdir / "cache"), max_size=10)
+    assert not cache.get("a", str(tmpdir / "missing"))
+
+    for name in ["a", "b"]:
+        (tmpdir / name).write_text(name * 5, encoding="UTF-8")
+        cache.put(name, str(tmpdir / name))
+    assert cache.get("a", str(tmpdir / "a2"))
+    assert os.stat(str(tmpdir / "a2")).st_ino == os.stat(cache.path("a")).st_ino
+    os.utime(cache.path("b") + ".used", (0, 0))
+
+    # Everything is linked to a target, so nothing can be evicted.
+    (tmpdir / "c").write_text("ccccc", encoding="UTF-8")
+    cache.put("c", str(tmpdir / "c"))
+    assert os.path.exists(cache.path("b"))
+
+    # Once the targets are gone, the least recently used one is evicted.
+    for name in ["a", "a2", "b", "c"]:
+        os.unlink(str(tmpdir / name))
+    cache.evict()
+    assert not os.path.exists(cache.path("b"))
+    assert os.path.exists(cache.path("a"))
+    assert os.path.exists(cache.path("c"))
+
+
+def test_symlink_and_cleanup_releases_artifacts_for_eviction(root, tmpdir):
+    cache = ArtifactCache(str(tmpdir / "cache"), max_size=10)
+    for version in ["v1", "v2", "v3"]:
+        target = tmpdir / f"{version}.tar.gz"
+        target.write_text(version * 2 + "x", "UTF-8")
+        cache.put(version, str(target))
+    os.symlink("v2.tar.gz", str(tmpdir / "current"))
+    os.symlink("v1.tar.gz", str(tmpdir / "last"))
+    (tmpdir / "trash").mkdir()
+
+    cleanup = SymlinkAndCleanup(
+        str(tmpdir / "v3.tar.gz"),
+        pattern="*.tar.gz",
+        trashdir=str(tmpdir / "trash"),
+        artifact_cache=cache,
+    )
+    cleanup.prepare(root)
+    cleanup.update()
+
+    assert not os.path.exists(tmpdir / "v1.tar.gz")
+    assert not os.path.exists(cache.path("v1"))
+    assert os.path.exists(cache.path("v2"))
+    assert os.path.exists(cache.path("v3"))
@@ -0,0 +1,180 @@
+import os
+import shutil
+import subprocess
+
+import batou.lib.git
+import pytest
+
+from batou_ext.git import Clone, GitWorktree, StopDeployOnLocalGitChange
+
+
+@pytest.fixture
+def upstream(tmpdir):
+    repo = str(tmpdir / "upstream")
+    os.makedirs(repo)
+
+    def git(*args):
+        return subprocess.run(
+            ["git", "-c", "user.name=t", "-c", "user.email=t@example.com"]
+            + list(args),
+            cwd=repo,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+
+    git("init", "-q", "-b", "main")
+    git("config", "uploadpack.allowFilter", "true")
+    with open(os.path.join(repo, "README"), "w") as f:
+        f.write("first")
+    git("add", "README")
+    git("commit", "-q", "-m", "first")
+    with open(os.path.join(repo, "README"), "w") as f:
+        f.write("second")
+    git("commit", "-q", "-am", "second")
+    return repo, git("rev-parse", "HEAD")
+
+
+@pytest.mark.parametrize("partial", [False, True])
+def test_clone_uses_reference_cache(root, tmpdir, upstream, partial):
+    url, revision = upstream
+    url = f"file://{url}"
+    clone = Clone(
+        url,
+        revision=revision,
+        target=str(tmpdir / "checkout"),
+        reference_cache=str(tmpdir / "cache"),
+        partial=partial,
+        shallow=True,
+    )
+    clone.prepare(root)
+    clone.deploy()
+
+    with open(tmpdir / "checkout" / "README") as f:
+        assert f.read() == "second"
+    assert clone.current_revision() == revision
+    with open(tmpdir / "checkout" / ".git/objects/info/alternates") as f:
+        assert f.read().strip() == os.path.join(clone.reference, "objects")
+
+    # A second deployment does not change anything.
+    clone.deploy()
+    assert not clone.changed
+
+    # The cache is shared with full clones, so it is never filtered.
+    filter_ = subprocess.run(
+        ["git", "config", "--get", "remote.origin.partialclonefilter"],
+        cwd=clone.reference,
+        capture_output=True,
+    )
+    assert not filter_.stdout
+
+
+@pytest.mark.parametrize(
+    "ref", [{"branch": "main"}, {"tag": "1.0"}], ids=["branch", "tag"]
+)
+def test_clone_of_branch_or_tag_is_stable(root, tmpdir, upstream, ref):
+    url, revision = upstream
+    subprocess.run(["git", "branch", "other"], cwd=url, check=True)
+    subprocess.run(["git", "tag", "1.0"], cwd=url, check=True)
+    clone = Clone(
+        f"file://{url}",
+        target=str(tmpdir / "checkout"),
+        partial=True,
+        shallow=True,
+        **ref,
+    )
+    clone.prepare(root)
+    clone.deploy()
+    assert clone.current_revision() == revision
+
+    clone.deploy()
+    assert not clone.changed
+
+    subprocess.run(
+        ["git", "-c", "user.name=t", "-c", "user.email=t@example.com"]
+        + ["commit", "-q", "--allow-empty", "-m", "third"],
+        cwd=url,
+        check=True,
+    )
+    subprocess.run(["git", "tag", "-f", "1.0"], cwd=url, check=True)
+    clone.deploy()
+    assert clone.changed
+    assert clone.current_revision() != revision
+
+
+def test_worktree_applies_exclude_as_sparse_checkout(root, tmpdir, upstream):
+    url, revision = upstream
+    clone = batou.lib.git.Clone(
+        f"file://{url}", revision=revision, target=str(tmpdir / "checkout")
+    )
+    clone.prepare(root)
+    clone.deploy()
+
+    path = str(tmpdir / f"prepared-{revision}")
+    worktree = GitWorktree(
+        path,
+        repository=str(tmpdir / "checkout"),
+        revision=revision,
+        exclude=("README",),
+    )
+    worktree.prepare(root)
+    worktree.deploy()
+    assert worktree.changed
+    assert os.path.isfile(os.path.join(path, ".git"))
+    assert not os.path.exists(os.path.join(path, "README"))
+
+    # Customized files in excluded paths are kept.
+    with open(os.path.join(path, "README"), "w") as f:
+        f.write("custom")
+    worktree.deploy()
+    assert not worktree.changed
+    with open(os.path.join(path, "README")) as f:
+        assert f.read() == "custom"
+
+    # A worktree which was moved away is pruned and created again.
+    shutil.rmtree(path)
+    worktree.exclude = ()
+    worktree.deploy()
+    assert worktree.changed
+    with open(os.path.join(path, "README")) as f:
+        assert f.read() == "second"
+    stdout = subprocess.run(
+        ["git", "worktree", "list", "--porcelain"],
+        cwd=str(tmpdir / "checkout"),
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    assert stdout.count("worktree ") == 2
+
+
+@pytest.mark.parametrize("accelerated", [False, True])
+def test_stop_deploy_on_local_git_change(root, upstream, accelerated):
+    repo, _ = upstream
+    component = StopDeployOnLocalGitChange(repo, accelerated=accelerated)
+    component.prepare(root)
+    component.verify()
+
+    # Touching a file without changing it is not a change.
+    os.utime(os.path.join(repo, "README"))
+    component.verify()
+
+    with open(os.path.join(repo, "new"), "w") as f:
+        f.write("untracked")
+    with pytest.raises(RuntimeError, match=r"\?\? new"):
+        component.verify()
+    os.unlink(os.path.join(repo, "new"))
+
+    with open(os.path.join(repo, "README"), "w") as f:
+        f.write("changed")
+    with pytest.raises(RuntimeError, match="M README"):
+        component.verify()
+
+    if accelerated:
+        stdout = subprocess.run(
+            ["git", "config", "--get", "core.untrackedCache"],
+            cwd=repo,
+            capture_output=True,
+            text=True,
+        ).stdout
+        assert stdout.strip() == "true"
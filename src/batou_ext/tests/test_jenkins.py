@@ -71,3 +71,80 @@ def test_simple_value_update_mode(tmpdir):
       update = pass:url
     """
     ) == ini.read_text(encoding="UTF-8")
+
+
+REFS = {
+    "HEAD": "1" * 40,
+    "refs/heads/main": "1" * 40,
+    "refs/heads/release/1.0": "2" * 40,
+    "refs/tags/1.0": "3" * 40,
+    "refs/tags/1.0^{}": "2" * 40,
+    "refs/tags/1.1": "4" * 40,
+}
+
+
+def test_match_ref():
+    assert batou_ext.jenkins.match_ref(REFS, "main") == "1" * 40
+    assert batou_ext.jenkins.match_ref(REFS, "release/1.0") == "2" * 40
+    # Annotated tags resolve to the tagged commit.
+    assert batou_ext.jenkins.match_ref(REFS, "1.0") == "2" * 40
+    assert batou_ext.jenkins.match_ref(REFS, "tags/1.1") == "4" * 40
+    assert batou_ext.jenkins.match_ref(REFS, "ease/1.0") is None
+    assert batou_ext.jenkins.match_ref(REFS, "2.0") is None
+
+
+def test_set_versions_lists_refs_once_per_url(tmpdir):
+    ini = tmpdir / "versions.ini"
+    ini.write_text(
+        dedent(
+            """
+            [prog1]
+            url = git://prog
+
+            [prog2]
+            url = git://prog
+
+            [prog3]
+            url = git://other
+            """
+        ),
+        encoding="UTF-8",
+    )
+
+    with mock.patch(
+        "batou_ext.jenkins.git_ls_remote_refs", return_value=REFS
+    ) as ls_remote:
+        batou_ext.jenkins.set_versions(
+            str(ini),
+            '{"prog1": "1.0", "prog2": "main", "prog3": "%s"}' % ("5" * 40),
+        )
+
+    ls_remote.assert_called_once_with("git://prog")
+    config = ini.read_text(encoding="UTF-8")
+    assert "revision = " + "2" * 40 in config
+    assert "revision = " + "1" * 40 in config
+    assert "revision = " + "5" * 40 in config
+
+
+def test_ref_cache(tmpdir):
+    cache = batou_ext.jenkins.RefCache(ttl=60, directory=str(tmpdir))
+    assert cache.cached("git://prog") == (None, None)
+
+    with mock.patch(
+        "batou_ext.jenkins.git_ls_remote_refs", return_value=REFS
+    ) as ls_remote:
+        assert cache("git://prog") == REFS
+        assert cache("git://prog") == REFS
+        ls_remote.assert_called_once_with("git://prog")
+
+        refs, age = cache.cached("git://prog")
+        assert list(refs.items()) == list(REFS.items())
+        assert 0 <= age < 60
+
+        cache.ttl = 0
+        cache("git://prog")
+        assert ls_remote.call_count == 2
+
+        updated = []
+        cache.refresh_in_background("git://prog", updated.append).join()
+        assert updated == [REFS]
@@ -0,0 +1,216 @@
+import json
+import os
+import sys
+from unittest import mock
+
+import batou
+import pytest
+
+from batou_ext.python import (
+    STORE_COMPLETE_MARKER,
+    InstallStep,
+    Pipenv,
+    PrecompileBytecode,
+    VirtualEnvRequirements,
+    diff_pipfile_locks,
+    pipfile_lock_requirement,
+)
+
+
+@pytest.fixture
+def store_venv(root, tmpdir):
+    (tmpdir / "requirements.txt").write_text("batou==2.5\n", encoding="UTF-8")
+    venv = VirtualEnvRequirements(
+        version="3.12",
+        requirements_path=str(tmpdir / "requirements.txt"),
+        store_dir=str(tmpdir / "store"),
+        store_link=str(tmpdir / "venv"),
+    )
+    venv.prepare(root)
+    os.makedirs(venv.store_dir)
+    return venv
+
+
+def test_store_digest_depends_on_requirements(store_venv, tmpdir):
+    digest = store_venv._store_digest()
+    assert digest == store_venv._store_digest()
+
+    (tmpdir / "requirements.txt").write_text("batou==2.6\n", encoding="UTF-8")
+    assert digest != store_venv._store_digest()
+
+
+def test_store_digest_depends_on_python_version(store_venv):
+    digest = store_venv._store_digest()
+    store_venv.version = "3.13"
+    assert digest != store_venv._store_digest()
+
+
+def test_store_verify_needs_update_without_requirements(store_venv, tmpdir):
+    (tmpdir / "requirements.txt").remove()
+    with pytest.raises(batou.UpdateNeeded):
+        store_venv.verify_install()
+
+
+def test_precompile_runs_after_install(root, tmpdir):
+    (tmpdir / "requirements.txt").write_text("batou==2.5\n", encoding="UTF-8")
+    venv = VirtualEnvRequirements(
+        version="3.12",
+        requirements_path=str(tmpdir / "requirements.txt"),
+        store_dir=str(tmpdir / "store"),
+        store_link=str(tmpdir / "venv"),
+        precompile=True,
+        precompile_paths=[str(tmpdir / "app")],
+    )
+    root.component += venv
+    root.prepare()
+
+    types = [type(c) for c in venv.sub_components]
+    assert types.index(InstallStep) + 1 == types.index(PrecompileBytecode)
+    assert venv._.paths == [str(tmpdir / "app")]
+
+
+def test_store_entry_is_precompiled_before_completion(root, store_venv, tmpdir):
+    venv = VirtualEnvRequirements(
+        version="3.12",
+        requirements_path=str(tmpdir / "requirements.txt"),
+        store_dir=str(tmpdir / "store"),
+        store_link=str(tmpdir / "venv"),
+        precompile=True,
+    )
+    venv.prepare(root)
+    assert venv._store_digest() != store_venv._store_digest()
+    entry = venv._store_entry()
+    # Built by `cmd`.
+    os.makedirs(entry)
+
+    def precompile():
+        assert venv._precompile.paths == [os.path.join(entry, "lib")]
+        assert not os.path.exists(os.path.join(entry, STORE_COMPLETE_MARKER))
+
+    precompile_update = mock.patch.object(
+        venv._precompile, "update", side_effect=precompile
+    )
+    with mock.patch.object(venv, "cmd"), precompile_update as update:
+        with mock.patch.object(venv.trash, "discard"):
+            venv._update_store()
+    update.assert_called_once()
+    assert os.path.exists(os.path.join(entry, STORE_COMPLETE_MARKER))
+    assert os.readlink(venv.store_link) == entry
+
+
+def test_store_garbage_excludes_linked_and_incomplete_entries(
+    store_venv, tmpdir
+):
+    store = tmpdir / "store"
+    for name in ["linked", "unused", "incomplete"]:
+        store.mkdir(name)
+    (store / "linked" / STORE_COMPLETE_MARKER).write_text("", "UTF-8")
+    (store / "unused" / STORE_COMPLETE_MARKER).write_text("", "UTF-8")
+
+    os.symlink(str(store / "linked"), store_venv.store_link)
+    ref = store_venv._store_ref()
+    os.makedirs(os.path.dirname(ref))
+    os.symlink(store_venv.store_link, ref)
+
+    assert store_venv._list_store_garbage() == [str(store / "unused")]
+
+
+def test_precompile_bytecode_skips_current_files(root, tmpdir):
+    (tmpdir / "app").mkdir()
+    (tmpdir / "app" / "module.py").write_text("x = 1\n", encoding="UTF-8")
+    precompile = PrecompileBytecode(str(tmpdir / "app"), python=sys.executable)
+    precompile.prepare(root)
+
+    with pytest.raises(batou.UpdateNeeded):
+        precompile.verify()
+    precompile.update()
+    precompile.verify()
+
+    # A new mtime with the same content does not invalidate the bytecode.
+    os.utime(tmpdir / "app" / "module.py", (0, 0))
+    precompile.verify()
+
+    (tmpdir / "app" / "module.py").write_text("x = 2\n", encoding="UTF-8")
+    with pytest.raises(batou.UpdateNeeded):
+        precompile.verify()
+
+
+def test_precompile_bytecode_does_not_read_unchanged_files(root, tmpdir):
+    (tmpdir / "app").mkdir()
+    module = tmpdir / "app" / "module.py"
+    module.write_text("x = 1\n", encoding="UTF-8")
+    precompile = PrecompileBytecode(str(tmpdir / "app"), python=sys.executable)
+    precompile.prepare(root)
+    precompile.update()
+    assert os.path.exists(precompile.state_file)
+
+    # Same size and mtime: the source is not read again.
+    stat = os.stat(module)
+    module.write_text("x = 2\n", encoding="UTF-8")
+    os.utime(module, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    precompile.verify()
+
+    os.remove(precompile.state_file)
+    with pytest.raises(batou.UpdateNeeded):
+        precompile.verify()
+
+
+def test_pipenv_incremental_detects_lock_changes(root, tmpdir):
+    lock = {
+        "_meta": {"hash": {"sha256": "pipfile"}, "requires": {}},
+        "default": {"attrs": {"version": "==23.1.0", "hashes": ["sha256:a"]}},
+    }
+    (tmpdir / "Pipfile.lock").write_text(json.dumps(lock), encoding="UTF-8")
+    pipenv = Pipenv(target=str(tmpdir), incremental=True)
+    pipenv.prepare(root)
+    os.makedirs(os.path.join(pipenv.venv, "bin"))
+    os.symlink(sys.executable, pipenv.executable)
+    pipenv._save_state(lock)
+    pipenv.verify_install()
+
+    # `pipenv lock` pinned a newer version, the Pipfile is unchanged.
+    lock["default"]["attrs"] = {"version": "==23.2.0", "hashes": ["sha256:b"]}
+    (tmpdir / "Pipfile.lock").write_text(json.dumps(lock), encoding="UTF-8")
+    with pytest.raises(batou.UpdateNeeded):
+        pipenv.verify_install()
+
+    with mock.patch.object(pipenv, "cmd") as cmd:
+        pipenv.update_install()
+    assert "pip install --no-deps --require-hashes" in cmd.call_args[0][0]
+    pipenv.verify_install()
+
+
+def test_diff_pipfile_locks():
+    old = {
+        "attrs": {"version": "==23.1.0", "hashes": ["sha256:a"]},
+        "six": {"version": "==1.16.0", "hashes": ["sha256:b"]},
+        "requests": {"version": "==2.31.0", "hashes": ["sha256:c"]},
+    }
+    new = {
+        "attrs": {"version": "==23.1.0", "hashes": ["sha256:a"]},
+        "requests": {"version": "==2.32.0", "hashes": ["sha256:d"]},
+        "idna": {"version": "==3.7", "hashes": ["sha256:e"]},
+    }
+    assert diff_pipfile_locks(old, new) == (["six"], ["idna", "requests"])
+
+
+def test_pipfile_lock_requirement():
+    assert (
+        pipfile_lock_requirement(
+            "uvicorn",
+            {
+                "extras": ["standard"],
+                "version": "==0.30.1",
+                "markers": "python_version >= '3.8'",
+                "hashes": ["sha256:a", "sha256:b"],
+            },
+        )
+        == "uvicorn[standard]==0.30.1; python_version >= '3.8'"
+        " --hash=sha256:a --hash=sha256:b"
+    )
+    assert (
+        pipfile_lock_requirement(
+            "mylib", {"git": "https://example.com/mylib.git", "ref": "abc"}
+        )
+        is None
+    )
@@ -0,0 +1,504 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+import types
+from unittest import mock
+
+import batou
+import pytest
+from botocore.response import StreamingBody
+
+import batou_ext.s3
+from batou_ext.file import ArtifactCache
+from batou_ext.s3 import (
+    S3,
+    Download,
+    DownloadAndExtract,
+    LifecycleRule,
+    Sync,
+)
+
+
+class FakeObject:
+    """A stand-in for a boto3 `s3.Object` resource."""
+
+    def __init__(self, data, e_tag='"etag-1"'):
+        self.data = data
+        self.e_tag = e_tag
+        self.ranges = []
+        self.meta = types.SimpleNamespace(
+            client=types.SimpleNamespace(get_object=self.get_object)
+        )
+
+    @property
+    def content_length(self):
+        return len(self.data)
+
+    def load(self):
+        pass
+
+    def get(self, IfMatch, Range=None):
+        assert IfMatch == self.e_tag
+        if Range is None:
+            Range = f"bytes=0-{len(self.data) - 1}"
+        start, end = map(int, Range[len("bytes=") :].split("-"))
+        self.ranges.append((start, end))
+        data = self.data[start : end + 1]
+        return {"Body": StreamingBody(io.BytesIO(data), len(data))}
+
+    def get_object(self, Bucket, Key, IfMatch, Range):
+        assert (Bucket, Key) == ("bucket", "key")
+        return self.get(IfMatch=IfMatch, Range=Range)
+
+
+@pytest.fixture
+def download(root):
+    def factory(data, **kw):
+        download = Download(
+            "key", bucketname="bucket", target="target", s3=mock.Mock(), **kw
+        )
+        download.prepare(root)
+        download.chunk_size = 4
+        download.obj = FakeObject(data)
+        return download
+
+    return factory
+
+
+def test_download_in_chunks_with_checksum(download):
+    data = b"0123456789"
+    checksum = hashlib.sha256(data).hexdigest()
+    d = download(data, checksum=f"sha256:{checksum}")
+    d.update()
+    with open(d.target, "rb") as f:
+        assert f.read() == data
+    assert sorted(d.obj.ranges) == [(0, 3), (4, 7), (8, 9)]
+    assert d.etag_file == d.target + ".etag"
+    with open(d.etag_file) as f:
+        assert f.read() == '"etag-1"'
+    assert not os.path.exists(d.target + ".part")
+    assert not os.path.exists(d.target + ".part.json")
+
+    d.verify()
+
+
+def test_download_checksum_mismatch(download):
+    d = download(b"0123456789", checksum="sha256:1234")
+    with pytest.raises(AssertionError):
+        d.update()
+
+
+def test_download_resumes(download):
+    data = b"0123456789"
+    d = download(data)
+    with open(d.target + ".part", "wb") as f:
+        f.write(b"0123\0\0\0\0\0\0")
+    with open(d.target + ".part.json", "w") as f:
+        json.dump(
+            {"etag": '"etag-1"', "size": 10, "chunk_size": 4, "done": [0]}, f
+        )
+    d.update()
+    assert sorted(d.obj.ranges) == [(4, 7), (8, 9)]
+    with open(d.target, "rb") as f:
+        assert f.read() == data
+
+
+def test_download_restarts_if_object_changed(download):
+    d = download(b"0123456789")
+    with open(d.target + ".part", "wb") as f:
+        f.write(b"abcd")
+    with open(d.target + ".part.json", "w") as f:
+        json.dump(
+            {"etag": '"etag-0"', "size": 10, "chunk_size": 4, "done": [0]}, f
+        )
+    d.update()
+    assert len(d.obj.ranges) == 3
+    with open(d.target, "rb") as f:
+        assert f.read() == b"0123456789"
+
+
+def test_download_empty_object(download):
+    d = download(b"")
+    d.update()
+    assert os.path.getsize(d.target) == 0
+
+
+def test_download_keeps_completed_chunks_on_error(download):
+    d = download(b"0123456789")
+    d.max_concurrency = 1
+    get = d.obj.get
+
+    def failing_get(Range, IfMatch):
+        if Range == "bytes=8-9":
+            raise ConnectionError()
+        return get(Range=Range, IfMatch=IfMatch)
+
+    d.obj.get = failing_get
+    with pytest.raises(ConnectionError):
+        d.update()
+    assert not os.path.exists(d.target)
+    with open(d.target + ".part.json") as f:
+        assert json.load(f)["done"] == [0, 1]
+
+
+def test_download_caches_checksum(download):
+    data = b"0123456789"
+    checksum = hashlib.sha256(data).hexdigest()
+    d = download(data, checksum=f"sha256:{checksum}")
+    d.update()
+    with open(d.checksum_file) as f:
+        assert json.load(f)["checksum"] == checksum
+
+    with mock.patch("batou.utils.hash") as hash:
+        d.verify()
+        hash.assert_not_called()
+
+        d.paranoid = True
+        hash.return_value = checksum
+        d.verify()
+        hash.assert_called_once()
+
+    # A stale cache of a correct file is renewed without an update.
+    d.paranoid = False
+    os.utime(d.target, (0, 0))
+    d.verify()
+    with mock.patch("batou.utils.hash") as hash:
+        d.verify()
+        hash.assert_not_called()
+
+    # Changing the file invalidates the cache.
+    with open(d.target, "wb") as f:
+        f.write(b"9876543210")
+    with pytest.raises(batou.UpdateNeeded):
+        d.verify()
+
+
+def test_download_links_from_artifact_cache(download, tmpdir):
+    data = b"0123456789"
+    checksum = hashlib.sha256(data).hexdigest()
+    cache = ArtifactCache(str(tmpdir / "cache"))
+    first = download(data, checksum=f"sha256:{checksum}")
+    first.artifact_cache = cache
+    first.update()
+    assert os.path.exists(cache.path(f"sha256:{checksum}"))
+
+    second = download(data, checksum=f"sha256:{checksum}")
+    second.target = str(tmpdir / "second")
+    second.etag_file = second.target + ".etag"
+    second.checksum_file = second.target + ".checksum"
+    second.artifact_cache = cache
+    second.update()
+    assert second.obj.ranges == []
+    assert os.stat(second.target).st_ino == os.stat(first.target).st_ino
+    second.verify()
+
+
+def make_tarball(mode, files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("mode", ["w:gz", "w:xz", "w"])
+def test_download_and_extract(root, mode):
+    data = make_tarball(mode, {"release/app.py": b"app", "release/._x": b""})
+    d = DownloadAndExtract(
+        "release.tar", bucketname="bucket", target="app", s3=mock.Mock()
+    )
+    d.prepare(root)
+    d.strip = 1
+    d.obj = FakeObject(data)
+    with pytest.raises(batou.UpdateNeeded):
+        d.verify()
+    d.update()
+    assert os.listdir(d.target) == ["app.py"]
+    with open(d.finish_marker) as f:
+        assert f.read() == '"etag-1"'
+    with open(d.archive, "rb") as f:
+        assert f.read() == data
+    # The ETag is only recorded in the marker.
+    assert not os.path.exists(d.archive + ".etag")
+    d.verify()
+
+    # A changed object is extracted again and replaces the directory.
+    d.obj = FakeObject(
+        make_tarball(mode, {"release/new.py": b"new"}), e_tag='"etag-2"'
+    )
+    with pytest.raises(batou.UpdateNeeded):
+        d.verify()
+    d.update()
+    assert os.listdir(d.target) == ["new.py"]
+    d.verify()
+    assert [n for n in os.listdir(root.workdir) if ".extract-" in n] == []
+
+
+def test_download_and_extract_without_archive(root):
+    data = make_tarball("w:gz", {"app.py": b"app"})
+    checksum = hashlib.sha256(data).hexdigest()
+    d = DownloadAndExtract(
+        "release.tar.gz",
+        bucketname="bucket",
+        target="app",
+        s3=mock.Mock(),
+        checksum=f"sha256:{checksum}",
+    )
+    d.prepare(root)
+    d.keep_archive = False
+    d.obj = FakeObject(data)
+    d.update()
+    assert not os.path.exists(d.archive)
+    assert not os.path.exists(d.archive + ".part")
+    d.verify()
+
+
+def test_download_and_extract_keeps_target_on_error(root):
+    d = DownloadAndExtract(
+        "release.tar.gz",
+        bucketname="bucket",
+        target="app",
+        s3=mock.Mock(),
+        checksum="sha256:1234",
+    )
+    d.prepare(root)
+    os.makedirs(d.target)
+    d.obj = FakeObject(make_tarball("w:gz", {"app.py": b"app"}))
+    with pytest.raises(AssertionError):
+        d.update()
+    assert os.listdir(d.target) == []
+    assert not os.path.exists(d.finish_marker)
+    assert not os.path.exists(d.archive)
+    assert [n for n in os.listdir(root.workdir) if ".extract-" in n] == []
+
+    d.obj = FakeObject(b"garbage")
+    d.checksum = None
+    with pytest.raises(RuntimeError, match="Extracting release.tar.gz"):
+        d.update()
+    assert os.listdir(d.target) == []
+
+
+def test_s3_resources_are_shared_and_created_lazily(root, monkeypatch):
+    monkeypatch.setattr(batou_ext.s3, "_resources", {})
+    with mock.patch("boto3.session.Session") as session:
+        s3 = S3(
+            access_key_id="id",
+            secret_access_key="secret",
+            endpoint_url="https://s3.example.com",
+        )
+        s3.prepare(root)
+        other = S3(
+            access_key_id="id",
+            secret_access_key="secret",
+            endpoint_url="https://s3.example.com",
+        )
+        other.prepare(root)
+        assert not session.called
+
+        s3.client.meta
+        other.client.meta
+        session.assert_called_once_with(
+            aws_access_key_id="id", aws_secret_access_key="secret"
+        )
+        config = session.return_value.resource.call_args.kwargs["config"]
+        assert config.max_pool_connections == 10
+        assert config.retries is None
+
+        other.max_attempts = 5
+        other.retry_mode = "adaptive"
+        other.configure()
+        other.client.meta
+        assert session.call_count == 2
+        config = session.return_value.resource.call_args.kwargs["config"]
+        assert config.retries == {"mode": "adaptive", "max_attempts": 5}
+
+
+def test_download_verifies_against_etag_snapshot(root):
+    s3 = S3(access_key_id="id", secret_access_key="secret", endpoint_url="u")
+    s3.prepare(root)
+    s3.client = mock.Mock()
+    objects = s3.client.Bucket.return_value.objects
+    objects.filter.return_value = [
+        mock.Mock(key="assets/a", e_tag='"a"'),
+        mock.Mock(key="assets/b", e_tag='"b"'),
+    ]
+
+    downloads = []
+    for key in ["assets/a", "assets/b", "assets/c"]:
+        d = Download(
+            key,
+            bucketname="bucket",
+            target=key.replace("/", "-"),
+            s3=s3,
+            batch_prefix="assets/",
+        )
+        d.prepare(root)
+        with open(d.target, "w") as f:
+            f.write("")
+        with open(d.etag_file, "w") as f:
+            f.write('"a"')
+        downloads.append(d)
+
+    downloads[0].verify()
+    with pytest.raises(batou.UpdateNeeded):
+        downloads[1].verify()
+    with pytest.raises(batou.UpdateNeeded):
+        downloads[2].verify()
+    objects.filter.assert_called_once_with(Prefix="assets/")
+    s3.client.Object.assert_not_called()
+
+
+def test_download_key_must_start_with_batch_prefix(root):
+    d = Download(
+        "other/a",
+        bucketname="bucket",
+        target="target",
+        s3=mock.Mock(),
+        batch_prefix="assets/",
+    )
+    with pytest.raises(ValueError, match="batch prefix"):
+        d.prepare(root)
+
+
+@pytest.fixture
+def s3(root, monkeypatch):
+    moto = pytest.importorskip("moto")
+    monkeypatch.setattr(batou_ext.s3, "_resources", {})
+    with moto.mock_aws():
+        s3 = S3(
+            access_key_id="id",
+            secret_access_key="secret",
+            endpoint_url="https://s3.amazonaws.com",
+        )
+        s3.prepare(root)
+        s3.client.create_bucket(Bucket="bucket")
+        yield s3
+
+
+def sync(root, s3, path, **kw):
+    sync = Sync(path, s3=s3, bucketname="bucket", prefix="assets/", **kw)
+    sync.prepare(root)
+    return sync
+
+
+def test_sync_download(root, s3, tmpdir):
+    bucket = s3.client.Bucket("bucket")
+    bucket.put_object(Key="assets/a.css", Body=b"a")
+    bucket.put_object(Key="assets/js/b.js", Body=b"b")
+    bucket.put_object(Key="other", Body=b"other")
+    path = str(tmpdir / "assets")
+    s = sync(root, s3, path)
+    with pytest.raises(batou.UpdateNeeded):
+        s.verify()
+    s.update()
+    s.verify()
+    with open(os.path.join(path, "js", "b.js")) as f:
+        assert f.read() == "b"
+    assert sorted(os.listdir(path)) == ["a.css", "js"]
+
+    # Only changed objects and locally modified files are downloaded.
+    bucket.put_object(Key="assets/a.css", Body=b"a2")
+    with open(os.path.join(path, "js", "b.js"), "w") as f:
+        f.write("modified")
+    with open(os.path.join(path, "extra"), "w") as f:
+        f.write("extra")
+    assert s._plan()[:2] == (["a.css", "js/b.js"], [])
+    s.update()
+    with open(os.path.join(path, "a.css")) as f:
+        assert f.read() == "a2"
+    with open(os.path.join(path, "js", "b.js")) as f:
+        assert f.read() == "b"
+    s.verify()
+
+    # Extraneous files are only removed if asked to.
+    bucket.delete_objects(Delete={"Objects": [{"Key": "assets/js/b.js"}]})
+    s = sync(root, s3, path, delete=True)
+    assert s._plan()[:2] == ([], ["extra", "js/b.js"])
+    s.update()
+    assert os.listdir(path) == ["a.css"]
+    s.verify()
+
+
+@pytest.mark.parametrize("key", ["assets/../escaped", "assets//etc/passwd"])
+def test_sync_download_rejects_keys_outside_of_path(root, s3, tmpdir, key):
+    s3.client.Bucket("bucket").put_object(Key=key, Body=b"x")
+    s = sync(root, s3, str(tmpdir / "assets"))
+    with pytest.raises(ValueError):
+        s.verify()
+    with pytest.raises(ValueError):
+        s.update()
+    assert not os.path.exists(tmpdir / "escaped")
+
+
+def test_sync_upload(root, s3, tmpdir):
+    path = tmpdir / "assets"
+    (path / "js").ensure(dir=True)
+    (path / "a.css").write("a")
+    (path / "js" / "b.js").write("b" * 20)
+    bucket = s3.client.Bucket("bucket")
+    bucket.put_object(Key="assets/extra", Body=b"extra")
+
+    s = sync(root, s3, str(path), direction="upload", chunk_size=5 * 2**20)
+    with pytest.raises(batou.UpdateNeeded):
+        s.verify()
+    s.update()
+    s.verify()
+    keys = sorted(obj.key for obj in bucket.objects.all())
+    assert keys == ["assets/a.css", "assets/extra", "assets/js/b.js"]
+
+    # Changed files and objects which were modified remotely are uploaded.
+    (path / "a.css").write("a2")
+    bucket.put_object(Key="assets/js/b.js", Body=b"changed")
+    s = sync(root, s3, str(path), direction="upload", delete=True)
+    assert s._plan()[:2] == (["a.css", "js/b.js"], ["extra"])
+    s.update()
+    s.verify()
+    keys = sorted(obj.key for obj in bucket.objects.all())
+    assert keys == ["assets/a.css", "assets/js/b.js"]
+    assert bucket.Object("assets/js/b.js").get()["Body"].read() == b"b" * 20
+
+
+def test_sync_uploads_large_files_in_parts(root, s3, tmpdir):
+    path = tmpdir / "assets"
+    path.ensure(dir=True)
+    (path / "large").write_binary(b"x" * (11 * 2**20))
+    s = sync(root, s3, str(path), direction="upload", chunk_size=5 * 2**20)
+    s.update()
+    etag = s3.client.Object("bucket", "assets/large").e_tag
+    # The ETag of a multipart upload ends with the number of parts.
+    assert etag.endswith('-3"')
+    s.verify()
+
+
+def test_lifecycle_rule(root, s3):
+    client = s3.client.meta.client
+    other = {
+        "ID": "other",
+        "Filter": {"Prefix": "other/"},
+        "Status": "Enabled",
+        "Expiration": {"Days": 1},
+    }
+    client.put_bucket_lifecycle_configuration(
+        Bucket="bucket", LifecycleConfiguration={"Rules": [other]}
+    )
+    rule = LifecycleRule(
+        "expire", s3=s3, bucketname="bucket", prefix="db/", expiration_days=7
+    )
+    rule.prepare(root)
+    with pytest.raises(batou.UpdateNeeded):
+        rule.verify()
+    rule.update()
+    rule.verify()
+
+    rule.expiration_days = 14
+    rule.configure()
+    with pytest.raises(batou.UpdateNeeded):
+        rule.verify()
+    rule.update()
+    rule.verify()
+    rules = client.get_bucket_lifecycle_configuration(Bucket="bucket")
+    assert [r["ID"] for r in rules["Rules"]] == ["other", "expire"]
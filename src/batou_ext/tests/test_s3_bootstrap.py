@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+from batou_ext import s3_bootstrap
+
+PLAN = """\
+host: cephosd.example.com
+accounts:
+  - rg: myrg
+    create: true
+    buckets:
+      - name: assets
+      - name: logs
+        lifecycle:
+          - prefix: /old/
+            days: 30
+"""
+
+
+@pytest.fixture
+def radosgw(monkeypatch):
+    calls = []
+
+    def remote_sudo(host, password, cmd):
+        calls.append((host, password, cmd))
+        if cmd[1:3] == ["user", "list"]:
+            return "[]"
+        if cmd[1:3] == ["key", "create"]:
+            keys = [{"access_key": "id", "secret_key": "secret"}]
+            return json.dumps({"keys": keys})
+        return ""
+
+    monkeypatch.setattr(s3_bootstrap, "remote_sudo", remote_sudo)
+    monkeypatch.setenv("S3_BOOTSTRAP_SUDO_PASSWORD", "pw")
+    return calls
+
+
+def test_ssh_connections_are_shared():
+    options = s3_bootstrap.ssh_options()
+    assert "ControlMaster=auto" in options
+    assert options == s3_bootstrap.ssh_options()
+
+
+def test_run_plan_file(tmpdir, radosgw, monkeypatch):
+    plan_file = tmpdir / "plan.yaml"
+    plan_file.write_text(PLAN, encoding="UTF-8")
+    created = {}
+
+    def verify(self, key):
+        assert key.key_id == "id"
+
+    def apply(self, key):
+        created[self.name] = None
+        return self.name
+
+    def apply_rules(self, client):
+        created[client] = list(self.rules)
+
+    monkeypatch.setattr(s3_bootstrap.CreateBucket, "verify", verify)
+    monkeypatch.setattr(s3_bootstrap.CreateBucket, "apply", apply)
+    monkeypatch.setattr(
+        s3_bootstrap.CreateLifecyclePolicyConfiguration, "apply", apply_rules
+    )
+
+    s3_bootstrap.run_plan_file(str(plan_file), yes=True)
+    assert created == {"assets": None, "logs": [("old/", 30)]}
+    assert [cmd[1:3] for _, _, cmd in radosgw] == [
+        ["user", "list"],
+        ["user", "create"],
+        ["key", "create"],
+    ]
+    assert {(host, pw) for host, pw, _ in radosgw} == {
+        ("cephosd.example.com", "pw")
+    }
+
+
+def test_plan_file_needs_host_for_accounts(tmpdir, radosgw):
+    plan_file = tmpdir / "plan.json"
+    plan_file.write_text(
+        json.dumps({"accounts": [{"rg": "myrg", "keypair": True}]}),
+        encoding="UTF-8",
+    )
+    with pytest.raises(s3_bootstrap.ConfigurationError, match="host"):
+        s3_bootstrap.read_plan_file(str(plan_file))
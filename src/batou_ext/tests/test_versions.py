@@ -0,0 +1,140 @@
+from unittest import mock
+
+from prompt_toolkit.document import Document
+
+from batou_ext.jenkins import RefCache
+from batou_ext.versions import (
+    EnvironmentHeader,
+    RefCompleter,
+    find_versions_ini,
+    get_git_version_completer,
+    read_environment_headers,
+    tag_sort_key,
+)
+
+REFS = {
+    "HEAD": "1" * 40,
+    "refs/heads/main": "1" * 40,
+    "refs/heads/feature/v2-login": "2" * 40,
+    "refs/pull/1/head": "3" * 40,
+    "refs/tags/v1.9.0": "4" * 40,
+    "refs/tags/v1.10.0": "5" * 40,
+    "refs/tags/v1.10.0^{}": "6" * 40,
+    "refs/tags/v2.0.0-rc1": "7" * 40,
+    "refs/tags/v2.0.0": "8" * 40,
+    "refs/tags/nightly": "9" * 40,
+}
+
+
+def complete(completer, text):
+    return [
+        c.text for c in completer.get_completions(Document(text), mock.Mock())
+    ]
+
+
+def test_tag_sort_key():
+    tags = ["nightly", "1.9", "v1.10.0", "2.0.0-rc1", "2.0.0", "1.2.3.4"]
+    assert sorted(tags, key=tag_sort_key) == [
+        "2.0.0",
+        "2.0.0-rc1",
+        "v1.10.0",
+        "1.9",
+        "1.2.3.4",
+        "nightly",
+    ]
+
+
+def test_tag_sort_key_orders_pre_releases_newest_first():
+    tags = ["2.0.0-rc1", "2.0.0-rc10", "2.0.0", "2.0.0-rc2", "1.0.0"]
+    assert sorted(tags, key=tag_sort_key) == [
+        "2.0.0",
+        "2.0.0-rc10",
+        "2.0.0-rc2",
+        "2.0.0-rc1",
+        "1.0.0",
+    ]
+
+
+def test_ref_completer():
+    completer = RefCompleter(REFS)
+    assert complete(completer, "") == [
+        "v2.0.0",
+        "v2.0.0-rc1",
+        "v1.10.0",
+        "v1.9.0",
+        "nightly",
+        "feature/v2-login",
+        "main",
+    ]
+    assert complete(completer, "v1") == ["v1.10.0", "v1.9.0"]
+    # Parts of names match, too.
+    assert complete(completer, "log") == ["feature/v2-login"]
+    assert complete(completer, "V2") == [
+        "v2.0.0",
+        "v2.0.0-rc1",
+        "feature/v2-login",
+    ]
+    assert complete(completer, "x") == []
+
+    completer.limit = 2
+    completer.set_refs(REFS)
+    assert complete(completer, "v") == ["v2.0.0", "v2.0.0-rc1"]
+
+
+def test_git_version_completer_refreshes_in_background(tmpdir):
+    cache = RefCache(ttl=60, directory=str(tmpdir))
+    with mock.patch(
+        "batou_ext.jenkins.git_ls_remote_refs", return_value=REFS
+    ) as ls_remote:
+        threads = []
+        refresh = cache.refresh_in_background
+        with mock.patch.object(
+            cache,
+            "refresh_in_background",
+            side_effect=lambda *args: threads.append(refresh(*args)),
+        ):
+            completer = get_git_version_completer("git://prog", cache)
+        threads[0].join()
+        assert "main" in complete(completer.completer, "ma")
+
+        # Fresh refs are taken from the cache.
+        get_git_version_completer("git://prog", cache)
+        ls_remote.assert_called_once_with("git://prog")
+
+
+def test_read_environment_headers(tmpdir, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir / "cache"))
+    for name, content in [
+        (
+            "prod",
+            """\
+[environment]
+branch = production
+connect_method = ssh
+
+[hosts]
+host1 = app
+
+[component:settings]
+versions_ini = versions-prod.ini
+""",
+        ),
+        ("dev", "[environment]\nbranch = main\n"),
+    ]:
+        (tmpdir / "environments" / name).ensure(dir=True)
+        (tmpdir / "environments" / name / "environment.cfg").write(content)
+    (tmpdir / "environments" / "README").write("")
+
+    headers = read_environment_headers(str(tmpdir))
+    assert [(h.name, h.branch) for h in headers] == [
+        ("dev", "main"),
+        ("prod", "production"),
+    ]
+    assert headers[1].overrides["settings"] == {
+        "versions_ini": "versions-prod.ini"
+    }
+
+    with mock.patch.object(EnvironmentHeader, "read") as read:
+        headers = read_environment_headers(str(tmpdir))
+    read.assert_not_called()
+    assert find_versions_ini(headers[1]) == "versions-prod.ini"
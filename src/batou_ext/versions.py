@@ -1,30 +1,233 @@
 import argparse
+import concurrent.futures
 import configparser
 import json
 import os
 import os.path
+import re
 import subprocess
 import sys
+import tempfile
 
 import batou.environment
 from InquirerPy import inquirer
-from prompt_toolkit.completion import FuzzyWordCompleter, ThreadedCompleter
+from prompt_toolkit.completion import Completer, Completion, ThreadedCompleter
 
-from batou_ext.jenkins import VersionsUpdater
+from batou_ext.jenkins import RefCache, VersionsUpdater, cache_dir
 
+# Seconds for which refs cached on disk are used without asking the remote.
+REF_CACHE_TTL = 60
+
+SEMVER = re.compile(r"v?(\d+)(?:\.(\d+))?(?:\.(\d+))?([-+~].*)?")
 
-def get_git_version_completer(url):
-    def get_words():
-        cmd = subprocess.Popen(
-            ["git", "ls-remote", url], stdout=subprocess.PIPE, encoding="UTF-8"
-        )
-        stdout, stderr = cmd.communicate()
-        words = []
-        for line in stdout.splitlines():
-            words.extend(line.split())
-        return words
 
-    return ThreadedCompleter(FuzzyWordCompleter(get_words))
+def tag_sort_key(tag):
+    """Sort key for tags: semantic versions, newest first, then the other
+    tags by name.
+    """
+    match = SEMVER.fullmatch(tag)
+    if not match:
+        return (1, (), tag)
+    major, minor, patch, rest = match.groups()
+    numbers = tuple(-int(n or 0) for n in (major, minor, patch))
+    # Pre-releases (`1.0-rc1`) come after their release, newest first, too.
+    return (0, numbers + (bool(rest), descending_key(rest or "")), tag)
+
+
+def descending_key(text):
+    """Sort key which orders `text` descending, numbers by their value."""
+    key = []
+    for i, part in enumerate(re.split(r"(\d+)", text)):
+        if i % 2:
+            key.append(-int(part))
+        else:
+            # The terminator sorts a prefix after the longer text.
+            key.append(tuple(-ord(c) for c in part) + (0,))
+    return tuple(key)
+
+
+class RefCompleter(Completer):
+    """Complete the short names of the branches and tags in `refs` (as
+    returned by `batou_ext.jenkins.git_ls_remote_refs`).
+
+    Tags are offered first, newest version first, then the branches. Names
+    match if the input is a prefix of the name or of one of its parts after
+    `/`, `-`, `_` or `.`. All candidates are indexed in a prefix trie, which
+    keeps at most `limit` names per node, so completing doesn't get slower
+    with the number of refs.
+    """
+
+    SEPARATORS = re.compile(r"[/_.-]")
+
+    def __init__(self, refs=None, limit=50):
+        self.limit = limit
+        self._trie = {}
+        self._names = []
+        self._meta = {}
+        if refs:
+            self.set_refs(refs)
+
+    def set_refs(self, refs):
+        tags = []
+        branches = []
+        for ref in refs:
+            if ref.endswith("^{}"):
+                continue
+            if ref.startswith("refs/tags/"):
+                tags.append(ref[len("refs/tags/") :])
+            elif ref.startswith("refs/heads/"):
+                branches.append(ref[len("refs/heads/") :])
+        tags.sort(key=tag_sort_key)
+        branches.sort()
+        meta = dict.fromkeys(branches, "branch")
+        meta.update(dict.fromkeys(tags, "tag"))
+
+        names = list(dict.fromkeys(tags + branches))
+        trie = {}
+        for name in names:
+            keys = {name.lower()}
+            for match in self.SEPARATORS.finditer(name):
+                keys.add(name[match.end() :].lower())
+            for key in keys:
+                node = trie
+                for char in key:
+                    node = node.setdefault(char, {"": []})
+                    if len(node[""]) < self.limit and name not in node[""]:
+                        node[""].append(name)
+        # Swap the index at once as a completion may be running in another
+        # thread.
+        self._trie, self._names, self._meta = trie, names, meta
+
+    def names(self, prefix):
+        """Return the names matching `prefix`, at most `limit`."""
+        if not prefix:
+            return self._names[: self.limit]
+        node = self._trie
+        for char in prefix.lower():
+            node = node.get(char)
+            if node is None:
+                return []
+        return node[""]
+
+    def get_completions(self, document, complete_event):
+        text = document.text_before_cursor
+        meta = self._meta
+        for name in self.names(text):
+            yield Completion(
+                name, start_position=-len(text), display_meta=meta.get(name)
+            )
+
+
+def get_git_version_completer(url, ref_cache=None):
+    """Complete the branches and tags of the git repository at `url`.
+
+    Refs are offered from the cache right away. If they are missing or
+    older than the cache's TTL, they are refreshed in the background and
+    the completions are updated when that is done.
+    """
+    if ref_cache is None:
+        ref_cache = RefCache(REF_CACHE_TTL)
+    refs, age = ref_cache.cached(url)
+    completer = RefCompleter(refs)
+    if refs is None or age >= ref_cache.ttl:
+        ref_cache.refresh_in_background(url, completer.set_refs)
+    return ThreadedCompleter(completer)
+
+
+class EnvironmentHeader:
+    """The `branch` and the settings (`[component:settings]`) of an
+    environment, read without loading the environment.
+
+    Can be used instead of a loaded environment in `find_versions_ini`
+    and `get_current_versions`.
+    """
+
+    SECTIONS = ("environment", "component:settings")
+
+    def __init__(self, name, branch=None, settings=None):
+        self.name = name
+        self.branch = branch
+        self.overrides = {"settings": settings or {}}
+
+    @classmethod
+    def read(cls, name, path):
+        """Parse only the wanted sections of the environment file `path`."""
+        lines = []
+        wanted = False
+        with open(path) as f:
+            for line in f:
+                if line.startswith("["):
+                    wanted = line.strip()[1:-1].strip() in cls.SECTIONS
+                if wanted:
+                    lines.append(line)
+        config = configparser.RawConfigParser()
+        config.optionxform = lambda option: option
+        config.read_string("".join(lines), source=path)
+        environment = config["environment"] if "environment" in config else {}
+        settings = (
+            dict(config["component:settings"])
+            if "component:settings" in config
+            else {}
+        )
+        return cls(name, environment.get("branch"), settings)
+
+    def to_dict(self):
+        return {"branch": self.branch, "settings": self.overrides["settings"]}
+
+
+def read_environment_headers(basedir: str, max_workers: int = 8):
+    """Return the `EnvironmentHeader` of all environments in `basedir`.
+
+    The headers are read in parallel and cached on disk by the modification
+    time of the environment files.
+    """
+    environments = os.path.join(basedir, "environments")
+    paths = {}
+    for name in sorted(os.listdir(environments)):
+        path = os.path.join(environments, name, "environment.cfg")
+        if os.path.exists(path):
+            paths[name] = os.path.abspath(path)
+
+    cache_file = os.path.join(cache_dir("environments"), "headers.json")
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    def read(name):
+        path = paths[name]
+        stat = os.stat(path)
+        key = f"{stat.st_mtime_ns}:{stat.st_size}"
+        cached = cache.get(path)
+        if cached and cached["key"] == key:
+            return EnvironmentHeader(name, **cached["header"]), None
+        header = EnvironmentHeader.read(name, path)
+        return header, {"key": key, "header": header.to_dict()}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        results = list(pool.map(read, paths))
+
+    headers = []
+    changed = False
+    for header, entry in results:
+        headers.append(header)
+        if entry:
+            cache[paths[header.name]] = entry
+            changed = True
+    if changed:
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(
+                dir=os.path.dirname(cache_file), suffix=".tmp"
+            )
+            with os.fdopen(fd, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp, cache_file)
+        except OSError:
+            # The cache is an optimization only.
+            pass
+    return headers
 
 
 def find_versions_ini(environment: batou.environment.Environment):
@@ -60,6 +263,13 @@ def select_versions_interactive(basedir: str) -> dict:
         multiselect=True,
     ).execute()
 
+    # Create all completers up front to refresh their refs concurrently.
+    completers = {}
+    for c in selected_components:
+        git_url = versions[c].get("url")
+        if git_url:
+            completers[c] = get_git_version_completer(git_url)
+
     interative_versions = {}
     for c in selected_components:
         try:
@@ -67,11 +277,7 @@ def select_versions_interactive(basedir: str) -> dict:
         except configparser.NoOptionError:
             default = ""
 
-        git_url = versions[c].get("url")
-        if git_url:
-            git_completer = get_git_version_completer(git_url)
-        else:
-            git_completer = None
+        git_completer = completers.get(c)
         new_version = inquirer.text(
             message=f"Update {c} to:",
             default=default,
@@ -80,6 +286,8 @@ def select_versions_interactive(basedir: str) -> dict:
 
         interative_versions[c] = new_version
 
+    # The cached refs are only good enough for completion, resolve the
+    # selected refs from the remote.
     set_versions(versions_ini, interative_versions)
     return interative_versions
 
@@ -102,18 +310,14 @@ def get_current_versions(
 
 def update_from_branch(basedir: str, branch: str):
     branch_is_used = False
-    envs = sorted(os.listdir(os.path.join(basedir, "environments")))
-
-    for env_name in envs:
-        environment = batou.environment.Environment(env_name)
-        environment.load()
 
+    for environment in read_environment_headers(basedir):
         if environment.branch != branch:
             continue
 
         branch_is_used = True
 
-        print(f"Updating environment: {env_name}")
+        print(f"Updating environment: {environment.name}")
         current_versions = get_current_versions(basedir, environment)
         versions_ini = find_versions_ini(environment)
         set_versions(versions_ini, current_versions)
@@ -132,8 +336,12 @@ def update_single(basedir: str, environment_name: str):
     set_versions(versions_ini, current_versions)
 
 
-def set_versions(versions_ini: str, target_versions: dict):
-    updater = VersionsUpdater(versions_ini, json.dumps(target_versions))
+def set_versions(
+    versions_ini: str, target_versions: dict, ref_cache_ttl: int = 0
+):
+    updater = VersionsUpdater(
+        versions_ini, json.dumps(target_versions), ref_cache_ttl
+    )
     updater()
     subprocess.run(["git", "-P", "diff", versions_ini])
 